@@ -0,0 +1,183 @@
+"""
+Per-chat affinity on a local cluster: the router (router.py) in front
+of several backend processes (wsgi.py), all replying to a fake Bot API.
+Checks that every chat is handled by the backend which owns it on the
+hash ring, that replies of every chat come in order, and that only the
+chats of a stopped backend move to other backends.
+
+    python benchmarks/affinity_cluster.py [backends] [chats] [updates]
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import tempfile
+import threading
+import subprocess
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.fake_bot_api import FakeBotAPI, make_update  # noqa E402
+from common.affinity import HashRing  # noqa E402
+
+TOKEN = '1:fake'
+METRICS_TOKEN = 'benchmark'
+BASE_PORT = 18700
+
+
+def start(args: list, env: dict, port: int) -> subprocess.Popen:
+    process = subprocess.Popen(
+        ['gunicorn', '-b', f'127.0.0.1:{port}'] + args,
+        cwd=ROOT, env={**os.environ, **env},
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=1)
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f'{args} did not start')
+
+
+def post(url: str, update: dict):
+    request = urllib.request.Request(
+        url, data=json.dumps(update).encode(), method='POST',
+        headers={'Content-Type': 'application/json'})
+    urllib.request.urlopen(request, timeout=30)
+
+
+def handled(backends: list) -> Counter:
+    """
+    Updates handled by every backend, from its own /metrics
+    """
+    counts = Counter()
+    for backend in backends:
+        try:
+            request = urllib.request.Request(
+                f'{backend}/metrics',
+                headers={'Authorization': f'Bearer {METRICS_TOKEN}'})
+            text = urllib.request.urlopen(request).read()
+        except OSError:
+            continue
+        for line in text.decode().splitlines():
+            if line.startswith('dicebot_updates_total'):
+                counts[backend] += int(line.split()[-1])
+    return counts
+
+
+def send_round(router: str, chats: int, updates: int, first: int):
+    """
+    Updates of every chat are sent one by one, chats in parallel
+    """
+    def send_chat(chat: int):
+        for number in range(first + chat, first + updates, chats):
+            update = make_update(number, chats)
+            update['message']['text'] = '/roll d20'
+            post(f'{router}/{TOKEN}', update)
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(send_chat, range(chats)))
+
+
+def wait_replies(server: FakeBotAPI, number: int):
+    for _ in range(300):
+        if server.replies >= number:
+            return
+        time.sleep(0.1)
+
+
+def ring_moves(backends: list, keys: range):
+    """
+    Share of keys moving to other backends when one joins or leaves
+    """
+    before = HashRing(backends)
+    joined = HashRing(backends + ['http://new'])
+    left = HashRing(backends[1:])
+    moved_join = sum(
+        before.node_for(key) != joined.node_for(key) for key in keys)
+    moved_leave = sum(
+        before.node_for(key) != left.node_for(key) for key in keys)
+    print(f'ring of {len(backends)}: a joining backend takes '
+          f'{moved_join / len(keys):.1%} of chats, a leaving one gives '
+          f'away {moved_leave / len(keys):.1%}')
+
+
+def main():
+    defaults = [3, 30, 600]
+    args = [int(arg) for arg in sys.argv[1:4]]
+    count, chats, updates = args + defaults[len(args):]
+    ring_moves([f'http://node{n}' for n in range(count)], range(100000))
+
+    server = FakeBotAPI(0, chats, delay=0.005)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    directory = tempfile.mkdtemp()
+    env = {
+        'TOKENS': TOKEN, 'URL': 'http://127.0.0.1/',
+        'TELEGRAM_API_URL': server.url,
+        'DATABASE_URL': f'sqlite:///{directory}/cluster.sqlite',
+        'ADMISSION_USER_BURST': '1000000', 'ADMISSION_USER_RATE': '1000000',
+        'ADMISSION_CHAT_BURST': '1000000', 'ADMISSION_CHAT_RATE': '1000000',
+        'DRAIN_TIMEOUT': '5', 'METRICS_TOKEN': METRICS_TOKEN,
+    }
+    backends = [
+        f'http://127.0.0.1:{BASE_PORT + 1 + number}'
+        for number in range(count)]
+    router = f'http://127.0.0.1:{BASE_PORT}'
+    ring = HashRing(backends)
+    owners = [ring.node_for(1000 + chat) for chat in range(chats)]
+    processes = []
+    try:
+        for number in range(count):
+            processes.append(start(
+                ['-c', 'gunicorn.conf.py', '-w', '1', 'wsgi:app'],
+                {**env,
+                 'METRICS_FILE': f'{directory}/backend{number}.metrics'},
+                BASE_PORT + 1 + number))
+        processes.append(start(
+            ['-k', 'gthread', '--threads', '16', 'router:app'],
+            {'BACKENDS': ','.join(backends)}, BASE_PORT))
+
+        send_round(router, chats, updates, 1)
+        wait_replies(server, updates)
+        expected = Counter()
+        for number in range(1, updates + 1):
+            expected[owners[number % chats]] += 1
+        print(f'{server.replies} of {updates} replies, '
+              f'{server.out_of_order} out of order')
+        print('handled as the ring says:', handled(backends) == expected)
+
+        stopped = backends[0]
+        processes[0].send_signal(signal.SIGTERM)
+        processes[0].wait()
+        moved = owners.count(stopped)
+        before = handled(backends[1:])
+        send_round(router, chats, updates, updates + 1)
+        wait_replies(server, 2 * updates)
+        after = handled(backends[1:])
+        print(f'stopped {stopped}: its {moved} of {chats} chats moved, '
+              f'{server.replies} of {2 * updates} replies, '
+              f'{server.out_of_order} out of order')
+        # chats of the stopped backend go to the next one on the ring
+        expected = Counter()
+        for number in range(updates + 1, 2 * updates + 1):
+            chat = 1000 + number % chats
+            expected[next(node for node in ring.nodes_for(chat)
+                          if node != stopped)] += 1
+        print('handled as the ring says:', after - before == expected)
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+                process.wait()
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""
+Per-face cost of dice rolling: module-level random.randint (the old
+path) against the block-buffered streams of common.rng.
+
+    python benchmarks/bench_rng.py
+"""
+
+import os
+import sys
+import random
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.rng import BlockRandom, SOURCES, make_source  # noqa E402
+
+
+FACES = 100_000
+
+
+def bench(name: str, roll, sides: int):
+    seconds = min(timeit.repeat(lambda: roll(sides), number=1, repeat=5))
+    print(f'{name:<22} d{sides:<4} {seconds / FACES * 1e9:8.1f} ns/face')
+
+
+def main():
+    for sides in (6, 20, 100, 999):
+        bench('random.randint', lambda s: [
+            random.randint(1, s) for _ in range(FACES)], sides)
+        for source in SOURCES:
+            rng = BlockRandom(make_source(source))
+            bench(f'{source} randint', lambda s: [
+                rng.randint(1, s) for _ in range(FACES)], sides)
+            bench(f'{source} faces', lambda s: rng.faces(s, FACES), sides)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""
+Throughput of long polling (bot_testmode.py) against a fake Bot API
+server. The fake serves a backlog of /roll commands from many chats
+with getUpdates and counts replies; handling order within every chat
+is checked by reply_to_message_id.
+
+    python benchmarks/fake_bot_api.py [updates] [chats] [workers] [delay]
+
+delay (milliseconds, 0 by default) is added to every reply to model the
+round trip to the real Bot API.
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# seconds to wait for all the replies
+TIME_LIMIT = 120
+
+
+class FakeBotAPI(ThreadingHTTPServer):
+    """
+    getUpdates honours offset and limit like Telegram does, sendMessage
+    and the rest of methods are answered with a stub message
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, updates: int, chats: int, delay: float = 0.0):
+        super().__init__(('127.0.0.1', 0), FakeHandler)
+        self.delay = delay
+        self.backlog = [make_update(number, chats)
+                        for number in range(1, updates + 1)]
+        self.confirmed = 0
+        self.replies = 0
+        self.out_of_order = 0
+        self.last_reply = defaultdict(int)
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def get_updates(self, params: dict) -> list:
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        with self.lock:
+            if offset > 0:
+                self.confirmed = max(self.confirmed, offset - 1)
+            elif offset < 0:
+                return self.backlog[offset:]
+            start = max(offset - 1, 0)
+            updates = self.backlog[start:start + limit]
+        if not updates:
+            # long polling with nothing to send
+            time.sleep(min(float(params.get('timeout') or 0), 0.1))
+        return updates
+
+    def reply(self, params: dict) -> dict:
+        chat_id = int(params.get('chat_id', 0))
+        reply_to = int(params.get('reply_to_message_id') or 0)
+        time.sleep(self.delay)
+        with self.lock:
+            self.replies += 1
+            if reply_to and reply_to < self.last_reply[chat_id]:
+                self.out_of_order += 1
+            self.last_reply[chat_id] = max(
+                reply_to, self.last_reply[chat_id])
+            if self.replies >= len(self.backlog):
+                self.done.set()
+        return {'message_id': 1, 'date': 0,
+                'chat': {'id': chat_id, 'type': 'private'}}
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'       # keep connections alive
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode()
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            params.update(json.loads(body or '{}'))
+        else:
+            params.update(parse_qsl(body))
+        method = url.path.rsplit('/', 1)[-1]
+        if method == 'getUpdates':
+            result = self.server.get_updates(params)
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Fake',
+                      'username': 'fake_bot'}
+        else:
+            result = self.server.reply(params)
+        data = json.dumps({'ok': True, 'result': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+def make_update(number: int, chats: int) -> dict:
+    chat_id = 1000 + number % chats
+    user = {'id': chat_id, 'is_bot': False, 'first_name': 'Player'}
+    return {
+        'update_id': number,
+        'message': {
+            'message_id': number, 'date': 0, 'from': user,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': '/roll 4d6kh3 + 2',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 5}],
+        },
+    }
+
+
+def main():
+    defaults = [2000, 50, 8, 0]
+    args = [int(arg) for arg in sys.argv[1:5]]
+    updates, chats, workers, delay = args + defaults[len(args):]
+    server = FakeBotAPI(updates, chats, delay / 1000)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    directory = tempfile.mkdtemp()
+    os.environ.update({
+        'TOKEN': '1:fake',
+        'TELEGRAM_API_URL': server.url,
+        'SQLITE_PATH': os.path.join(directory, 'bench.sqlite'),
+        'METRICS_FILE': os.path.join(directory, 'bench.metrics'),
+        'POLLING_WORKERS': str(workers),
+        'POLLING_SKIP_PENDING': '0',
+        'POLLING_TIMEOUT': '1',
+        # the fake chats are way too fast for the per-chat rate limits
+        'ADMISSION_CHAT_RATE': '1000000',
+        'ADMISSION_CHAT_BURST': '1000000',
+        'ADMISSION_USER_RATE': '1000000',
+        'ADMISSION_USER_BURST': '1000000',
+    })
+    os.chdir(ROOT)
+    import bot_testmode
+
+    runner = bot_testmode.make_runner()
+    result = {}
+
+    def stop_when_done():
+        result['finished'] = server.done.wait(TIME_LIMIT)
+        result['seconds'] = time.perf_counter() - started
+        runner.stop()
+
+    started = time.perf_counter()
+    threading.Thread(target=stop_when_done, daemon=True).start()
+    bot_testmode.run_long_polling(runner)
+    finished, seconds = result['finished'], result['seconds']
+
+    print(f'{server.replies} of {updates} updates from {chats} chats '
+          f'handled by {workers} workers in {seconds:.2f} s '
+          f'({server.replies / seconds:.0f} updates/s)'
+          + ('' if finished else ', timed out'))
+    print(f'out of order replies: {server.out_of_order}, '
+          f'confirmed up to update {server.confirmed}')
+    totals = bot_testmode.counters.totals()
+    handled = sum(totals['buckets']) or 1
+    print(f'mean handler time: {totals["latency_sum"] / handled * 1000:.1f} '
+          'ms')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,10 @@
 """
-Used to run the bot in longpolling mode locally.
-SQLite in-memory database is in use.
+Used to run the bot in longpolling mode locally or on a single small
+box. Without DATABASE_URL the database is an embedded SQLite file
+(SQLITE_PATH, dicebot.sqlite by default) in WAL mode.
+
+Updates are fetched in batches and handled by a pool of worker threads,
+keeping the order of updates within a chat (see common/polling.py).
 """
 
 import os
@@ -10,35 +14,38 @@ import telebot
 from flask import Flask
 
 import models
+from common.background import writer
+from common.database import bind_database
+from common.metrics import counters
+from common.polling import PollingRunner
 
 
 botlogger = logging.getLogger('botlogger')
 
 
 TOKEN = os.environ.get('TOKEN')
-URL = os.environ.get('URL')
-DATABASE_URL = os.environ.get('DATABASE_URL')
+# seconds Telegram holds a getUpdates request open waiting for updates
+POLLING_TIMEOUT = int(os.environ.get('POLLING_TIMEOUT', 30))
+POLLING_WORKERS = int(os.environ.get('POLLING_WORKERS', 8))
+POLLING_BATCH_SIZE = int(os.environ.get('POLLING_BATCH_SIZE', 100))
+POLLING_DRAIN_TIMEOUT = float(os.environ.get('POLLING_DRAIN_TIMEOUT', 30))
+POLLING_SKIP_PENDING = os.environ.get('POLLING_SKIP_PENDING', '1') == '1'
+# another Bot API server, like a local one or a fake for benchmarks
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'dicebot.sqlite')
+DATABASE_URL = os.environ.get('DATABASE_URL') or f'sqlite:///{SQLITE_PATH}'
 
 if not TOKEN:
     botlogger.warning('TOKEN should be defined as system var')
-if not URL:
-    botlogger.warning('URL should be defined as system var')
 
 # connecting to database
-creds, host_and_database = DATABASE_URL[11:].split('@')
-host_and_port, database = host_and_database.split('/')
-host, port = host_and_port.split(':')
-user, password = creds.split(':')
-
-models.db.bind(provider='postgres', user=user, password=password,
-               host=host, port=port, database=database)
-models.db.generate_mapping(create_tables=True)
-
 botlogger.info('Starting database...')
-import models  # noqa E402
+bind_database(models.db, DATABASE_URL)
 
-# Setting bot
-bot = telebot.TeleBot(TOKEN)
+# Setting bot: handlers are called by the polling workers
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL.rstrip('/') + '/bot{0}/{1}'
+bot = telebot.TeleBot(TOKEN, threaded=False)
 tblogger = telebot.logger
 telebot.logger.setLevel(logging.INFO)
 
@@ -56,9 +63,23 @@ with app.app_context():
     BotHandlers.register()
 
 
-def run_long_polling():
+def make_runner() -> PollingRunner:
+    return PollingRunner(
+        bot, workers=POLLING_WORKERS, batch_size=POLLING_BATCH_SIZE,
+        timeout=POLLING_TIMEOUT, drain_timeout=POLLING_DRAIN_TIMEOUT,
+        skip_pending=POLLING_SKIP_PENDING)
+
+
+def run_long_polling(runner: PollingRunner = None):
     botlogger.info('Starting polling...')
-    bot.infinity_polling(skip_pending=True)
+    from handlers import inline_debouncer
+    (runner or make_runner()).run()
+    inline_debouncer.drain(POLLING_DRAIN_TIMEOUT)
+    # store what the handled updates left in memory
+    if not writer.flush(timeout=POLLING_DRAIN_TIMEOUT):
+        botlogger.warning(
+            '%s buffered writes were not stored', writer.pending)
+    counters.flush()
 
 
 if __name__ == '__main__':
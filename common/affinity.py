@@ -0,0 +1,77 @@
+"""
+Consistent hashing of chats to backends. Every backend owns many
+points on a hash ring and a chat belongs to the backend of the first
+point after the hash of the chat id, so when a backend joins or leaves
+only the chats of that backend move.
+"""
+
+import hashlib
+from bisect import bisect
+from typing import Iterator, List
+
+from common.polling import EVENT_FIELDS, MESSAGE_FIELDS
+
+
+# points of every backend on the ring; more points spread chats evenly
+REPLICAS = 400
+
+
+def ring_hash(value: str) -> int:
+    """
+    Hash which is the same in every process (unlike hash())
+    """
+    digest = hashlib.md5(value.encode()).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+def update_key(data: dict) -> int:
+    """
+    Id of the chat (or the user) of an update in JSON, see
+    common.polling.chat_key()
+    """
+    for name in MESSAGE_FIELDS:
+        message = data.get(name)
+        if message:
+            return message['chat']['id']
+    callback = data.get('callback_query')
+    if callback and callback.get('message'):
+        return callback['message']['chat']['id']
+    for name in EVENT_FIELDS:
+        event = data.get(name)
+        if event and event.get('from'):
+            return event['from']['id']
+    return data.get('update_id', 0)
+
+
+class HashRing:
+
+    def __init__(self, nodes: List[str], replicas: int = REPLICAS):
+        points = sorted(
+            (ring_hash(f'{node}#{number}'), node)
+            for node in nodes for number in range(replicas))
+        self.nodes = list(nodes)
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node_for(self, key: object) -> str:
+        """
+        Backend owning the key
+        """
+        return next(self.nodes_for(key), None)
+
+    def nodes_for(self, key: object) -> Iterator[str]:
+        """
+        All backends in ring order from the owner of the key on: the
+        next one takes the key when the previous ones are down
+        """
+        if not self._hashes:
+            return
+        start = bisect(self._hashes, ring_hash(str(key)))
+        seen = set()
+        for offset in range(len(self._owners)):
+            node = self._owners[(start + offset) % len(self._owners)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == len(self.nodes):
+                    return
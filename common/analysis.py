@@ -0,0 +1,252 @@
+"""
+Process pool for CPU-heavy analysis, like exact odds of big formulas,
+so that one heavy request does not stall rolls in the request threads.
+
+Every job has a hard deadline: a worker process running over it is
+killed and replaced, and a job still queued at its deadline is dropped.
+Identical jobs in flight are run once, and results are cached by job
+key, as well as errors raised by jobs (but not timeouts, they depend on
+the load).
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Callable, Hashable
+
+from common.cache import TTLCache
+
+
+analysislogger = logging.getLogger('analysislogger')
+
+
+class AnalysisError(RuntimeError):
+    """
+    Raised when a job could not be done
+    """
+
+
+class AnalysisTimeout(AnalysisError):
+
+    def __init__(self, message: str = 'This formula takes too long to '
+                                      'compute, try a simpler one.'):
+        super().__init__(message)
+
+
+class AnalysisBusy(AnalysisError):
+
+    def __init__(self, message: str = 'Too many heavy requests right now, '
+                                      'try again in a minute.'):
+        super().__init__(message)
+
+
+def serve(conn):
+    """
+    Loop of a worker process: call jobs and send back the outcome
+    """
+    while True:
+        try:
+            func, args = conn.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            outcome = (True, func(*args))
+        except Exception as exc:
+            outcome = (False, exc)
+        try:
+            conn.send(outcome)
+        except Exception as exc:
+            # the result or the error cannot be pickled
+            conn.send((False, AnalysisError(str(exc))))
+
+
+class Worker:
+    """
+    A worker process with a pipe to it
+    """
+
+    def __init__(self, context):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(
+            target=serve, args=(child,), name='analysis-worker', daemon=True)
+        self.process.start()
+        child.close()
+
+    def call(self, func: Callable, args: tuple, timeout: float):
+        self.conn.send((func, args))
+        if not self.conn.poll(timeout):
+            raise AnalysisTimeout()
+        ok, value = self.conn.recv()
+        if not ok:
+            raise value
+        return value
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class Job:
+
+    __slots__ = ('key', 'func', 'args', 'deadline', 'future')
+
+    def __init__(self, key: Hashable, func: Callable, args: tuple,
+                 deadline: float):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.deadline = deadline
+        self.future = Future()
+
+
+class AnalysisPool:
+    """
+    Bounded pool of worker processes, started with the first job.
+
+    * workers: number of processes; with 0 jobs run in the calling
+      thread (results are still cached)
+    * max_queue: jobs waiting for a worker, more are refused
+    * deadline: seconds a job may take from submission to result
+    * cache_ttl, cache_size: results cache
+    """
+
+    def __init__(self, workers: int = 2, max_queue: int = 32,
+                 deadline: float = 5.0, cache_ttl: float = 3600.0,
+                 cache_size: int = 1000):
+        self.workers = workers
+        self.deadline = deadline
+        self.cache = TTLCache(ttl=cache_ttl, maxsize=cache_size)
+        self._jobs = queue.Queue(maxsize=max_queue)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        methods = multiprocessing.get_all_start_methods()
+        # workers must not inherit threads and connections of the app
+        self._context = multiprocessing.get_context(
+            'forkserver' if 'forkserver' in methods else 'spawn')
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            workers=int(os.environ.get('ANALYSIS_WORKERS', 2)),
+            max_queue=int(os.environ.get('ANALYSIS_QUEUE', 32)),
+            deadline=float(os.environ.get('ANALYSIS_DEADLINE', 5)),
+            cache_ttl=float(os.environ.get('ANALYSIS_CACHE_TTL', 3600)),
+        )
+
+    def run(self, key: Hashable, func: Callable, *args):
+        """
+        Result of func(*args), cached by key. func and args must be
+        picklable (func defined at a module level). Raises errors of
+        func, AnalysisTimeout or AnalysisBusy.
+        """
+        outcome = self.cache.get(key)
+        if outcome is None:
+            outcome = self._outcome(key, func, args)
+        ok, value = outcome
+        if not ok:
+            raise value
+        return value
+
+    def start(self):
+        """
+        Start worker processes now rather than with the first job
+        """
+        if self.workers:
+            with self._lock:
+                self._start()
+
+    def _outcome(self, key: Hashable, func: Callable, args: tuple) -> tuple:
+        if not self.workers:
+            try:
+                outcome = (True, func(*args))
+            except Exception as exc:
+                outcome = (False, exc)
+            self.cache.set(key, outcome)
+            return outcome
+
+        with self._lock:
+            job = self._inflight.get(key)
+            if job is None:
+                self._start()
+                job = Job(key, func, args, time.monotonic() + self.deadline)
+                try:
+                    self._jobs.put_nowait(job)
+                except queue.Full:
+                    return (False, AnalysisBusy())
+                self._inflight[key] = job
+        try:
+            # the worker thread enforces the deadline, this is a safety net
+            return job.future.result(
+                max(job.deadline - time.monotonic(), 0) + 1.0)
+        except FutureTimeout:
+            return (False, AnalysisTimeout())
+
+    def _finish(self, job: Job, outcome: tuple):
+        if outcome[0] or not isinstance(outcome[1], AnalysisError):
+            self.cache.set(job.key, outcome)
+        with self._lock:
+            self._inflight.pop(job.key, None)
+        job.future.set_result(outcome)
+
+    def _start(self):
+        """
+        Start worker threads, in a new or forked process. Called with
+        self._lock held.
+        """
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._threads = [
+            threading.Thread(target=self._serve, daemon=True,
+                             name=f'analysis-{number}')
+            for number in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _serve(self):
+        """
+        Feed jobs to a worker process of the own
+        """
+        try:
+            worker = Worker(self._context)
+        except OSError as exc:
+            analysislogger.error('Cannot start analysis worker: %s', exc)
+            worker = None
+        while True:
+            job = self._jobs.get()
+            remaining = job.deadline - time.monotonic()
+            if remaining <= 0:
+                self._finish(job, (False, AnalysisTimeout()))
+                continue
+            try:
+                if worker is None:
+                    worker = Worker(self._context)
+                outcome = (True, worker.call(job.func, job.args, remaining))
+            except AnalysisTimeout as exc:
+                analysislogger.warning(
+                    'Job %s ran over the deadline, restarting worker',
+                    job.key)
+                worker.kill()
+                worker = None
+                outcome = (False, exc)
+            except (EOFError, OSError) as exc:
+                analysislogger.error('Analysis worker died: %s', exc)
+                if worker is not None:
+                    worker.kill()
+                worker = None
+                outcome = (False, AnalysisError(
+                    'Could not compute it, try again later.'))
+            except Exception as exc:
+                outcome = (False, exc)
+            self._finish(job, outcome)
+
+
+analyzer = AnalysisPool.from_env()
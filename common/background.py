@@ -0,0 +1,216 @@
+"""
+Write-behind queue: handlers submit database writes which are not
+needed for the reply, and a background thread commits them in batches.
+While the database is unavailable writes are spooled in memory and
+replayed once it is back.
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+from collections import deque
+
+from pony.orm import db_session
+
+from common.database import UNAVAILABLE_ERRORS
+
+
+bglogger = logging.getLogger('bglogger')
+
+# queued by flush(): the event is set once the writes before it commit
+FLUSH_MARKER = object()
+
+
+class BackgroundWriter:
+    """
+    Runs submitted callables in a daemon thread, up to batch_size of
+    them within a single db_session (one transaction per batch).
+    Spooled writes are guarded by _spool_lock: the thread replays them
+    while submit() may spool more.
+    """
+
+    def __init__(self, batch_size: int = 100, maxsize: int = 10000,
+                 spool_size: int = 100000, retry_interval: float = 5.0):
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._spool = deque()
+        self._spool_size = spool_size
+        self._spool_lock = threading.Lock()
+        self._overflow = 0          # writes spooled by submit() unlogged
+        self._overflow_logged = 0.0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queue func(*args, **kwargs). If the queue is full (the database
+        is slow or down) the write goes to the spool, so the caller
+        never waits for the database.
+        """
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((func, args, kwargs))
+        except queue.Full:
+            self._overflow_write((func, args, kwargs))
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Wait until everything queued so far is committed and replay the
+        spool. False if some writes are still queued or spooled after
+        timeout seconds (see pending).
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining():
+            if deadline is None:
+                return None
+            return max(deadline - time.monotonic(), 0)
+
+        if self._thread is not None:
+            done = threading.Event()
+            try:
+                self._queue.put(
+                    (FLUSH_MARKER, (done,), {}), timeout=remaining())
+            except queue.Full:
+                return False
+            if not done.wait(remaining()):
+                return False
+        while self._spool:
+            if remaining() == 0:
+                return False
+            if not self._replay():
+                # still unavailable
+                pause = self.retry_interval
+                if deadline is not None:
+                    pause = min(pause, remaining())
+                time.sleep(pause)
+        return True
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._loop, name='background-writer', daemon=True)
+                self._thread.start()
+
+    @property
+    def spooled(self) -> int:
+        return len(self._spool)
+
+    @property
+    def pending(self) -> int:
+        """
+        Writes not committed yet, queued or spooled
+        """
+        return self._queue.qsize() + len(self._spool)
+
+    def _overflow_write(self, task: tuple):
+        with self._spool_lock:
+            self._spool.append(task)
+            dropped = self._trim_spool()
+            self._overflow += 1
+            now = time.monotonic()
+            if now - self._overflow_logged < self.retry_interval:
+                overflow = 0
+            else:
+                overflow, self._overflow = self._overflow, 0
+                self._overflow_logged = now
+        if overflow:
+            bglogger.warning(
+                'Write queue is full, %s writes spooled', overflow)
+        if dropped:
+            bglogger.error('Write spool is full, dropped %s writes', dropped)
+
+    def _loop(self):
+        # replay the spool at once while the database takes the writes
+        wait = self.retry_interval
+        while True:
+            try:
+                batch = [self._queue.get(
+                    timeout=wait if self._spool else None)]
+            except queue.Empty:
+                wait = 0 if self._replay() else self.retry_interval
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            markers = [args[0] for func, args, _ in batch
+                       if func is FLUSH_MARKER]
+            writes = [task for task in batch if task[0] is not FLUSH_MARKER]
+            if writes and self._run(writes) and self._spool:
+                self._replay()
+            for _ in batch:
+                self._queue.task_done()
+            # the writes before the markers are committed or spooled now
+            for done in markers:
+                done.set()
+
+    def _replay(self) -> bool:
+        """
+        Retry a batch of spooled writes, oldest first. False if the
+        database is still unavailable.
+        """
+        batch = []
+        with self._spool_lock:
+            while self._spool and len(batch) < self.batch_size:
+                batch.append(self._spool.popleft())
+        if not batch:
+            return True
+        if not self._run(batch, replayed=True):
+            return False
+        bglogger.info(
+            'Replayed %s spooled writes, %s left',
+            len(batch), len(self._spool))
+        return True
+
+    def _run(self, batch: list, replayed: bool = False) -> bool:
+        try:
+            with db_session:
+                for func, args, kwargs in batch:
+                    func(*args, **kwargs)
+            return True
+        except UNAVAILABLE_ERRORS as exc:
+            self._spool_batch(batch, exc, replayed)
+        except Exception as exc:
+            bglogger.error('Batch of %s writes failed: %s', len(batch), exc)
+            if len(batch) > 1:
+                # retry one by one not to lose the writes next to a bad one
+                for task in batch:
+                    self._run([task])
+        return False
+
+    def _spool_batch(self, batch: list, exc: Exception, replayed: bool):
+        with self._spool_lock:
+            if replayed:
+                # back to the front, keeping the order
+                self._spool.extendleft(reversed(batch))
+            else:
+                self._spool.extend(batch)
+            dropped = self._trim_spool()
+        bglogger.warning(
+            'Database is unavailable, %s writes spooled: %s',
+            len(self._spool), exc)
+        if dropped:
+            bglogger.error('Write spool is full, dropped %s writes', dropped)
+
+    def _trim_spool(self) -> int:
+        """
+        Drop the newest writes over spool_size, under _spool_lock
+        """
+        dropped = 0
+        while len(self._spool) > self._spool_size:
+            self._spool.pop()
+            dropped += 1
+        return dropped
+
+
+writer = BackgroundWriter(
+    batch_size=int(os.environ.get('WRITE_BATCH_SIZE', 100)),
+    spool_size=int(os.environ.get('WRITE_SPOOL_SIZE', 100000)))
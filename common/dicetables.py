@@ -0,0 +1,126 @@
+"""
+Precomputed distribution tables in a binary file. The file is mapped
+into memory on the first lookup, so every worker process of a host
+reads the same pages and nothing is copied: a lookup returns a
+memoryview into the mapping.
+
+File layout (little-endian): magic, version, layout checksum and number
+of tables (4 x uint32), then an index entry per table (key1, key2,
+total offset, position of the first value, number of values; 5 x int32),
+padding to 8 bytes and all values as float64.
+"""
+
+import os
+import mmap
+import struct
+import logging
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+
+
+tableslogger = logging.getLogger('tableslogger')
+
+MAGIC = 0x44544231          # "DTB1"
+VERSION = 1
+HEADER = struct.Struct('<4I')
+ENTRY = struct.Struct('<5i')
+VALUE = 8
+
+Key = Tuple[int, int]
+
+
+def values_start(number: int) -> int:
+    """
+    File position of values after the index of `number` tables
+    """
+    size = HEADER.size + number * ENTRY.size
+    return -(-size // VALUE) * VALUE
+
+
+def write_tables(path: str, tables: Iterable[Tuple[Key, int, list]],
+                 checksum: int = 0) -> int:
+    """
+    Write (key, offset, values) tables into a file, return its size.
+    The file is replaced atomically, workers which have the old one
+    mapped keep reading it.
+    """
+    tables = list(tables)
+    index, position = [], 0
+    for (first, second), offset, values in tables:
+        index.append(ENTRY.pack(first, second, offset, position, len(values)))
+        position += len(values)
+    temp = f'{path}.tmp'
+    with open(temp, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, VERSION, checksum, len(tables)))
+        file.write(b''.join(index))
+        file.write(bytes(values_start(len(tables)) - file.tell()))
+        for _, _, values in tables:
+            file.write(struct.pack(f'<{len(values)}d', *values))
+        size = file.tell()
+    os.replace(temp, path)
+    return size
+
+
+class DiceTables:
+    """
+    Read-only tables from a file made by write_tables(). A missing or
+    stale file (other checksum) is not an error: lookups return None
+    and callers compute the values themselves.
+    """
+
+    def __init__(self, path: str, checksum: int = 0):
+        self.path = path
+        self.checksum = checksum
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._values = None
+        self._index: Dict[Key, Tuple[int, int, int]] = {}
+
+    def get(self, first: int, second: int) -> Optional[Tuple[int, memoryview]]:
+        """
+        (offset, values) of a table, None if there is no such table
+        """
+        if not self._loaded:
+            self.load()
+        entry = self._index.get((first, second))
+        if entry is None:
+            return None
+        offset, position, size = entry
+        return offset, self._values[position:position + size]
+
+    def load(self):
+        """
+        Map the file, done by the first lookup
+        """
+        with self._lock:
+            if self._loaded:
+                return
+            try:
+                self._map()
+            except (OSError, TypeError, ValueError, struct.error) as exc:
+                tableslogger.warning(
+                    'Dice tables %s are not used: %s', self.path, exc)
+                self._index = {}
+            self._loaded = True
+
+    def _map(self):
+        with open(self.path, 'rb') as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, checksum, number = HEADER.unpack_from(data)
+        if (magic, version) != (MAGIC, VERSION):
+            raise ValueError('not a dice tables file')
+        if checksum != self.checksum:
+            raise ValueError('built for other limits, rebuild them')
+        start = values_start(number)
+        values = memoryview(data)[start:].cast('d')
+        index = {}
+        for i in range(number):
+            first, second, offset, position, size = ENTRY.unpack_from(
+                data, HEADER.size + i * ENTRY.size)
+            if position + size > len(values):
+                raise ValueError('file is truncated')
+            index[first, second] = (offset, position, size)
+        self._values = values
+        self._index = index
+        tableslogger.info(
+            'Mapped %s dice tables from %s', number, self.path)
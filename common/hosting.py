@@ -0,0 +1,147 @@
+"""
+Several bots (tokens) served by one app process. The bots share the
+database pool, templates, one HTTP session to the Bot API and one pool
+of threads handling updates, so every extra bot costs only its own
+handler registrations.
+
+A host which is going down drains: it waits for the taken updates to
+be handled and refuses new ones. Under gunicorn the worker has stopped
+accepting requests by then, so refusing only guards against updates
+submitted while the drain starts.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable, Dict, List
+
+import requests
+import telebot
+from requests.adapters import HTTPAdapter
+from telebot import apihelper
+
+from common.polling import chat_key
+
+
+hostinglogger = logging.getLogger('hostinglogger')
+
+
+def bot_label(token: str) -> str:
+    """
+    Public part of a token, the id of the bot: safe for logs and metrics
+    """
+    return token.partition(':')[0]
+
+
+def share_session(connections: int):
+    """
+    Make all bots and threads send requests through one session, with
+    up to `connections` kept-alive connections to the Bot API
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    apihelper.session = session
+
+
+class BotHost:
+    """
+    Bots by token. Bots are created with threaded=False and their
+    updates are handled by the shared `workers` threads. Updates of a
+    chat always go to the same thread, so they are handled in order.
+    A handler which sleeps stalls every chat of its thread: handlers
+    which wait (like debounced inline queries) hand the work over to
+    their own threads instead.
+    """
+
+    def __init__(self, tokens: List[str], workers: int = 4):
+        self.bots: Dict[str, telebot.TeleBot] = {
+            token: telebot.TeleBot(token, threaded=False)
+            for token in tokens
+        }
+        self.labels = [bot_label(token) for token in self.bots]
+        self.workers = workers
+        self.draining = False
+        self.lanes = [
+            ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix=f'updates-{number}')
+            for number in range(workers)
+        ]
+        self._pending = set()
+        self._lock = threading.Lock()
+        share_session(workers)
+
+    @property
+    def default(self) -> telebot.TeleBot:
+        """
+        The first bot, None if there are no tokens
+        """
+        return next(iter(self.bots.values()), None)
+
+    def submit(self, token: str, update: telebot.types.Update) -> bool:
+        """
+        Queue an update of the bot with the token, False if there is no
+        such bot or the host is draining
+        """
+        bot = self.bots.get(token)
+        if bot is None:
+            return False
+        lane = self.lanes[hash(chat_key(update)) % len(self.lanes)]
+        # atomic with drain(): no update is taken after it looked
+        with self._lock:
+            if self.draining:
+                return False
+            try:
+                future = lane.submit(self._process, bot, update)
+            except RuntimeError:
+                # the lanes are shut down already
+                return False
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return True
+
+    def warm_up(self, func: Callable[[], None], timeout: float = 10.0):
+        """
+        Call func in every update thread at once, e.g. to open
+        connections the threads will use
+        """
+        barrier = threading.Barrier(self.workers)
+
+        def warm():
+            try:
+                func()
+            finally:
+                barrier.wait(timeout)
+
+        futures = [lane.submit(warm) for lane in self.lanes]
+        for future in wait(futures, timeout).done:
+            if future.exception() is not None:
+                hostinglogger.warning(
+                    'Warming up failed: %s', future.exception())
+                break
+
+    def drain(self, timeout: float) -> int:
+        """
+        Stop taking updates and wait up to timeout seconds for the taken
+        ones, return how many were not handled
+        """
+        with self._lock:
+            self.draining = True
+            pending = list(self._pending)
+        left = len(wait(pending, timeout).not_done)
+        for lane in self.lanes:
+            lane.shutdown(wait=False, cancel_futures=True)
+        return left
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def _process(self, bot: telebot.TeleBot, update: telebot.types.Update):
+        try:
+            bot.process_new_updates([update])
+        except Exception as exc:
+            hostinglogger.error(
+                'Update %s of bot %s failed: %s', update.update_id,
+                bot_label(bot.token), exc)
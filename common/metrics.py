@@ -0,0 +1,379 @@
+"""
+Counters shared by all worker processes of a host: rolls, handled
+commands and handler latency, in total and per bot. They live in a
+memory-mapped file (METRICS_FILE, in /dev/shm when available).
+
+Every process claims a row of its own and is the only writer of it, so
+updates need no cross-process locking: a slot is bumped under a
+process-local lock. Readers sum the rows. A snapshot of database
+statistics is kept in the same file, so /stats and /metrics never
+touch the database; a background thread flushes rolls of the row to
+the database and refreshes the snapshot from time to time.
+"""
+
+import os
+import mmap
+import time
+import zlib
+import fcntl
+import atexit
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+metricslogger = logging.getLogger('metricslogger')
+
+MAGIC = 0x44494345          # "DICE"
+SLOT = 8                    # every slot is a signed 64-bit integer
+
+COMMANDS = (
+    'start', 'help', 'stats', 'info', 'char', 'chars', 'createchar',
+    'deletechar', 'activechar', 'createroll', 'deleteroll', 'addmod',
+    'deletemod', 'roll', 'rollme', 'roll20', 'roll12', 'roll10', 'roll8',
+    'roll6', 'roll4', 'odds', 'history', 'joinparty', 'leaveparty',
+    'party', 'exportchar', 'importchar', 'inline', 'callback_query',
+    'throttled', 'other',
+)
+# upper bounds of latency buckets, seconds; the last one is +Inf
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SNAPSHOT_SIZE = 16
+# bots of one app counted separately (see common/hosting.py)
+MAX_BOTS = 16
+
+# header: magic, layout checksum, rows, snapshot time, snapshot mark,
+# snapshot length, snapshot values, time the refresh is claimed until
+HEADER_SLOTS = 7 + SNAPSHOT_SIZE
+REFRESH_CLAIM = 6 + SNAPSHOT_SIZE
+# seconds a process may take to refresh the snapshot before another one
+# takes over
+REFRESH_TIMEOUT = 60
+# row: pid, rolls, flushed rolls, latency sum (microseconds),
+# commands, latency buckets, updates and latency sum of every bot
+ROW_PID, ROW_ROLLS, ROW_FLUSHED, ROW_LATENCY = range(4)
+ROW_COMMANDS = 4
+ROW_BUCKETS = ROW_COMMANDS + len(COMMANDS)
+ROW_BOTS = ROW_BUCKETS + len(LATENCY_BUCKETS) + 1
+ROW_SLOTS = ROW_BOTS + 2 * MAX_BOTS
+
+
+def default_path() -> str:
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    return os.path.join(
+        directory or tempfile.gettempdir(),
+        f'tabletopdicebot-{os.getuid()}.metrics')
+
+
+def layout_checksum(rows: int) -> int:
+    layout = (f'{rows} {COMMANDS} {LATENCY_BUCKETS} {SNAPSHOT_SIZE} '
+              f'{MAX_BOTS} {HEADER_SLOTS}')
+    return zlib.crc32(layout.encode())
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedCounters:
+    """
+    Counter segment of a host. Flushing is set up with on_flush();
+    the flusher thread starts with the first counted roll.
+    """
+
+    def __init__(self, path: str = None, rows: int = 64,
+                 flush_interval: float = 10.0,
+                 snapshot_interval: float = 60.0):
+        # processes of different versions never share a segment
+        self.path = f'{path or default_path()}.{layout_checksum(rows):08x}'
+        self.rows = rows
+        self.flush_interval = flush_interval
+        self.snapshot_interval = snapshot_interval
+        self._flush = None
+        self._refresh = None
+        self._lock = threading.Lock()
+        self._slots = None          # the whole segment
+        self._own = None            # slots of the own row
+        self._fd = None
+        self._pid = None
+        self._thread = None
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            path=os.environ.get('METRICS_FILE') or None,
+            rows=int(os.environ.get('METRICS_ROWS', 64)),
+            flush_interval=float(
+                os.environ.get('METRICS_FLUSH_INTERVAL', 10)),
+            snapshot_interval=float(
+                os.environ.get('STATS_REFRESH_INTERVAL', 60)),
+        )
+
+    def on_flush(self, flush: Callable[[int], None],
+                 refresh: Callable[[], List[int]]):
+        """
+        flush(number) stores rolls counted since the last flush,
+        refresh() returns fresh statistics values for the snapshot
+        """
+        self._flush = flush
+        self._refresh = refresh
+
+    #
+    # Writers
+    #
+    def count_rolls(self, number: int = 1):
+        with self._lock:
+            self._own_row()[ROW_ROLLS] += number
+        self._ensure_flusher()
+
+    def count_command(self, command: str, seconds: float, bot: int = 0):
+        """
+        Count a handled update and its latency; bot is the number of
+        the bot which got the update
+        """
+        index = COMMANDS.index(command if command in COMMANDS else 'other')
+        bucket = len(LATENCY_BUCKETS)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                bucket = i
+                break
+        with self._lock:
+            row = self._own_row()
+            row[ROW_COMMANDS + index] += 1
+            row[ROW_BUCKETS + bucket] += 1
+            row[ROW_LATENCY] += int(seconds * 1_000_000)
+            if 0 <= bot < MAX_BOTS:
+                row[ROW_BOTS + 2 * bot] += 1
+                row[ROW_BOTS + 2 * bot + 1] += int(seconds * 1_000_000)
+
+    #
+    # Readers
+    #
+    def totals(self) -> Dict[str, object]:
+        """
+        Counters summed over all rows
+        """
+        with self._lock:
+            self._own_row()
+            values = [0] * ROW_SLOTS
+            for row in range(self.rows):
+                base = HEADER_SLOTS + row * ROW_SLOTS
+                for i in range(1, ROW_SLOTS):
+                    values[i] += self._slots[base + i]
+        return {
+            'rolls': values[ROW_ROLLS],
+            'flushed': values[ROW_FLUSHED],
+            'latency_sum': values[ROW_LATENCY] / 1_000_000,
+            'commands': dict(zip(COMMANDS, values[ROW_COMMANDS:ROW_BUCKETS])),
+            'buckets': values[ROW_BUCKETS:ROW_BOTS],
+            'bots': [
+                (values[ROW_BOTS + 2 * bot],
+                 values[ROW_BOTS + 2 * bot + 1] / 1_000_000)
+                for bot in range(MAX_BOTS)],
+        }
+
+    def snapshot(self) -> Tuple[Optional[List[int]], int, float]:
+        """
+        Statistics snapshot: (values or None, flushed rolls when it was
+        taken, age in seconds)
+        """
+        with self._lock:
+            self._own_row()
+            slots = self._slots
+            taken, mark, size = slots[3], slots[4], slots[5]
+            if not taken:
+                return None, 0, float('inf')
+            return list(slots[6:6 + size]), mark, time.time() - taken
+
+    def refresh_snapshot(self):
+        """
+        Take a statistics snapshot, unless another process does it.
+        The database is queried without the file lock, so a stalled
+        database never blocks processes opening the segment.
+        """
+        if self._refresh is None:
+            return
+        with self._file_lock(blocking=False) as locked:
+            if not locked:
+                return
+            with self._lock:
+                now = time.time()
+                if self._slots[REFRESH_CLAIM] > now:
+                    return
+                self._slots[REFRESH_CLAIM] = int(now + REFRESH_TIMEOUT)
+        try:
+            mark = self.totals()['flushed']
+            values = list(self._refresh())[:SNAPSHOT_SIZE]
+        except BaseException:
+            with self._lock:
+                self._slots[REFRESH_CLAIM] = 0
+            raise
+        with self._file_lock(), self._lock:
+            slots = self._slots
+            slots[6:6 + len(values)] = array_of(values)
+            slots[5] = len(values)
+            slots[4] = mark
+            slots[3] = int(time.time())
+            slots[REFRESH_CLAIM] = 0
+
+    def prometheus(self, bots: List[str] = ()) -> str:
+        """
+        Counters in Prometheus text format; bots are labels of bots
+        by their numbers
+        """
+        totals = self.totals()
+        lines = [
+            '# TYPE dicebot_rolls_total counter',
+            f'dicebot_rolls_total {totals["rolls"]}',
+            '# TYPE dicebot_updates_total counter',
+        ]
+        for command, number in totals['commands'].items():
+            lines.append(
+                f'dicebot_updates_total{{command="{command}"}} {number}')
+        lines.append('# TYPE dicebot_handler_seconds histogram')
+        cumulative = 0
+        bounds = [str(bound) for bound in LATENCY_BUCKETS] + ['+Inf']
+        for bound, number in zip(bounds, totals['buckets']):
+            cumulative += number
+            lines.append(
+                f'dicebot_handler_seconds_bucket{{le="{bound}"}} '
+                f'{cumulative}')
+        lines.append(f'dicebot_handler_seconds_sum {totals["latency_sum"]}')
+        lines.append(f'dicebot_handler_seconds_count {cumulative}')
+        if bots:
+            lines.append('# TYPE dicebot_bot_updates_total counter')
+            lines.extend(
+                f'dicebot_bot_updates_total{{bot="{label}"}} {updates}'
+                for label, (updates, _) in zip(bots, totals['bots']))
+            lines.append('# TYPE dicebot_bot_handler_seconds_sum counter')
+            lines.extend(
+                f'dicebot_bot_handler_seconds_sum{{bot="{label}"}} {seconds}'
+                for label, (_, seconds) in zip(bots, totals['bots']))
+        return '\n'.join(lines) + '\n'
+
+    #
+    # Flushing
+    #
+    def flush(self):
+        """
+        Store rolls of the own row counted since the last flush
+        """
+        with self._lock:
+            row = self._own_row()
+            pending = row[ROW_ROLLS] - row[ROW_FLUSHED]
+        if not pending or self._flush is None:
+            return
+        try:
+            self._flush(pending)
+        except Exception as exc:
+            metricslogger.error('Cannot flush %s rolls: %s', pending, exc)
+            return
+        with self._lock:
+            self._own_row()[ROW_FLUSHED] += pending
+
+    def _ensure_flusher(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._loop, name='metrics-flusher', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+            if self.snapshot()[2] > self.snapshot_interval:
+                try:
+                    self.refresh_snapshot()
+                except Exception as exc:
+                    metricslogger.error('Cannot refresh stats: %s', exc)
+
+    #
+    # Segment
+    #
+    def _own_row(self) -> memoryview:
+        """
+        Slots of the row of this process; (re)opens the segment in a new
+        or forked process. Called with self._lock held.
+        """
+        if self._pid != os.getpid():
+            self._open()
+        return self._own
+
+    def _open(self):
+        self._pid = os.getpid()
+        self._thread = None
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = (HEADER_SLOTS + self.rows * ROW_SLOTS) * SLOT
+        checksum = layout_checksum(self.rows)
+        with self._file_lock():
+            if os.fstat(self._fd).st_size != size:
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+            segment = mmap.mmap(self._fd, size)
+            slots = memoryview(segment).cast('q')
+            if slots[0] != MAGIC or slots[1] != checksum:
+                segment[:] = bytes(size)
+                slots[0], slots[1], slots[2] = MAGIC, checksum, self.rows
+            self._slots = slots
+            self._own = self._claim_row()
+
+    def _claim_row(self) -> memoryview:
+        """
+        Take the row of a dead process (keeping its counts, unflushed
+        rolls are flushed by the new owner) or an unused one
+        """
+        free = None
+        for row in range(self.rows):
+            base = HEADER_SLOTS + row * ROW_SLOTS
+            pid = self._slots[base + ROW_PID]
+            if pid == self._pid:
+                free = base
+                break
+            if free is None and (not pid or not pid_alive(pid)):
+                free = base
+        if free is None:
+            metricslogger.warning(
+                'All %s metrics rows are taken, counters of process %s '
+                'are not shared', self.rows, self._pid)
+            return memoryview(bytearray(ROW_SLOTS * SLOT)).cast('q')
+        self._slots[free + ROW_PID] = self._pid
+        return self._slots[free:free + ROW_SLOTS]
+
+    @contextmanager
+    def _file_lock(self, blocking: bool = True):
+        """
+        Exclusive lock on the segment file, for rare operations only
+        """
+        if self._fd is None:
+            with self._lock:
+                self._own_row()
+        flags = fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB)
+        try:
+            fcntl.flock(self._fd, flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+def array_of(values: List[int]) -> memoryview:
+    return memoryview(
+        b''.join(int(v).to_bytes(SLOT, 'little', signed=True)
+                 for v in values)).cast('q')
+
+
+counters = SharedCounters.from_env()
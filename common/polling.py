@@ -0,0 +1,231 @@
+"""
+Long-polling runner: fetches updates with getUpdates in batches and
+hands them to a pool of worker threads. Updates of one chat always go
+to the same worker, so they are handled in order, while different
+chats are handled in parallel.
+
+An update is confirmed to Telegram (the getUpdates offset moves past
+it) only after it and all the updates before it are handled, so
+updates which were not handled are delivered again after a restart.
+The offset stays at the oldest pending update, so getUpdates returns
+at most batch_size updates from there on: a slow update holds the
+runner back to batch_size updates ahead of it, whatever the number of
+workers.
+
+On SIGTERM or SIGINT the runner stops fetching, lets the workers finish
+what they have and confirms it.
+"""
+
+import time
+import queue
+import signal
+import logging
+import threading
+
+
+pollinglogger = logging.getLogger('pollinglogger')
+
+MAX_BACKOFF = 30.0
+
+
+# update fields with a message, which has a chat
+MESSAGE_FIELDS = ('message', 'edited_message', 'channel_post',
+                  'edited_channel_post')
+# update fields with an event of a user
+EVENT_FIELDS = ('callback_query', 'inline_query', 'chosen_inline_result',
+                'shipping_query', 'pre_checkout_query', 'my_chat_member',
+                'chat_member', 'chat_join_request')
+
+
+def chat_key(update: object) -> int:
+    """
+    Id of the chat (or the user) an update belongs to
+    """
+    for name in MESSAGE_FIELDS:
+        message = getattr(update, name, None)
+        if message is not None:
+            return message.chat.id
+    callback = getattr(update, 'callback_query', None)
+    if callback is not None and callback.message is not None:
+        return callback.message.chat.id
+    for name in EVENT_FIELDS:
+        event = getattr(update, name, None)
+        if event is not None and getattr(event, 'from_user', None):
+            return event.from_user.id
+    return update.update_id
+
+
+class PollingRunner:
+    """
+    Runs a TeleBot created with threaded=False, so that handlers are
+    called right in the worker threads.
+
+    * workers: number of worker threads
+    * batch_size: max updates per getUpdates request (Telegram allows 100)
+    * timeout: seconds a getUpdates request waits for new updates
+    * max_pending: updates fetched but not handled yet, fetching waits
+      while there are more of them. Up to batch_size (the default):
+      more could never be fetched, see the offset above
+    * drain_timeout: seconds to finish pending updates on shutdown
+    """
+
+    def __init__(self, bot, workers: int = 8, batch_size: int = 100,
+                 timeout: int = 30, max_pending: int = None,
+                 drain_timeout: float = 30.0, allowed_updates: list = None,
+                 skip_pending: bool = False):
+        self.bot = bot
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.max_pending = min(max_pending or batch_size, batch_size)
+        self.drain_timeout = drain_timeout
+        self.allowed_updates = allowed_updates
+        self.skip_pending = skip_pending
+        self.handled = 0
+        self._queues = [queue.Queue() for _ in range(workers)]
+        self._threads = []
+        self._pending = set()       # ids of fetched, not handled updates
+        self._last_seen = None      # the greatest fetched update id
+        self._progress = threading.Condition()
+        self._stopping = threading.Event()
+
+    @property
+    def offset(self):
+        """
+        getUpdates offset confirming all handled updates, but not
+        the pending ones
+        """
+        with self._progress:
+            if self._pending:
+                return min(self._pending)
+            if self._last_seen is not None:
+                return self._last_seen + 1
+            return None
+
+    def stop(self, *_):
+        """
+        Stop fetching and drain; safe to call from a signal handler
+        """
+        if not self._stopping.is_set():
+            pollinglogger.info('Stopping, draining pending updates...')
+        self._stopping.set()
+        with self._progress:
+            self._progress.notify_all()
+
+    def run(self, install_signals: bool = True):
+        """
+        Fetch and handle updates until stop() (or SIGTERM/SIGINT, when
+        run in the main thread)
+        """
+        if (install_signals
+                and threading.current_thread() is threading.main_thread()):
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+        self._stopping.clear()
+        self._start_workers()
+        if self.skip_pending:
+            self._skip_pending()
+        backoff = 1.0
+        while not self._stopping.is_set():
+            self._wait_for_room()
+            if self._stopping.is_set():
+                break
+            try:
+                updates = self.bot.get_updates(
+                    offset=self.offset, limit=self.batch_size,
+                    # read timeout of the request itself
+                    timeout=self.timeout + 5,
+                    long_polling_timeout=self.timeout,
+                    allowed_updates=self.allowed_updates)
+            except Exception as exc:
+                pollinglogger.error(
+                    'getUpdates failed, retrying in %s s: %s', backoff, exc)
+                self._stopping.wait(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+                continue
+            backoff = 1.0
+            if not self._dispatch(updates) and updates:
+                # only pending updates came back: wait for some progress
+                with self._progress:
+                    self._progress.wait(1.0)
+        self._drain()
+
+    def _skip_pending(self):
+        updates = self.bot.get_updates(
+            offset=-1, limit=1, timeout=5, long_polling_timeout=1)
+        if updates:
+            self._last_seen = updates[-1].update_id
+            pollinglogger.info('Skipped updates up to %s', self._last_seen)
+
+    def _wait_for_room(self):
+        with self._progress:
+            while (len(self._pending) >= self.max_pending
+                   and not self._stopping.is_set()):
+                self._progress.wait(1.0)
+
+    def _dispatch(self, updates: list) -> int:
+        """
+        Queue new updates to workers by chat, return how many were new
+        """
+        new = 0
+        for update in updates:
+            with self._progress:
+                if (self._last_seen is not None
+                        and update.update_id <= self._last_seen):
+                    continue        # pending one fetched again
+                self._last_seen = update.update_id
+                self._pending.add(update.update_id)
+            index = hash(chat_key(update)) % len(self._queues)
+            self._queues[index].put(update)
+            new += 1
+        return new
+
+    def _start_workers(self):
+        self._threads = [
+            threading.Thread(target=self._work, args=(jobs,),
+                             name=f'polling-worker-{number}', daemon=True)
+            for number, jobs in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self, jobs: queue.Queue):
+        while True:
+            update = jobs.get()
+            if update is None:
+                return
+            try:
+                self.bot.process_new_updates([update])
+            except Exception as exc:
+                pollinglogger.error(
+                    'Update %s failed: %s', update.update_id, exc)
+            with self._progress:
+                self._pending.discard(update.update_id)
+                self.handled += 1
+                self._progress.notify_all()
+
+    def _drain(self):
+        deadline = time.monotonic() + self.drain_timeout
+        for jobs in self._queues:
+            jobs.put(None)
+        for thread in self._threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+        left = len(self._pending)
+        if left:
+            pollinglogger.warning(
+                '%s updates were not handled in time and will be '
+                'delivered again', left)
+        self._commit()
+        pollinglogger.info('Stopped after %s updates', self.handled)
+
+    def _commit(self):
+        """
+        Confirm handled updates without waiting for new ones
+        """
+        offset = self.offset
+        if offset is None:
+            return
+        try:
+            self.bot.get_updates(
+                offset=offset, limit=1, timeout=5, long_polling_timeout=1)
+        except Exception as exc:
+            pollinglogger.error('Cannot confirm handled updates: %s', exc)
@@ -0,0 +1,180 @@
+"""
+Randomness for dice rolls. Faces are taken from a byte buffer which is
+refilled in large blocks from a fast PRNG or from the OS entropy pool,
+and mapped to faces with rejection sampling, so every face is equally
+likely.
+
+Every thread gets its own stream. Source is chosen with DICE_RNG system
+var (prng, urandom, secrets), DICE_RNG_SEED makes prng streams
+reproducible.
+"""
+
+import os
+import random
+import secrets
+import threading
+from itertools import count
+from typing import Callable, List, Union
+
+
+BLOCK_SIZE = 4096
+
+SOURCES = ('prng', 'urandom', 'secrets')
+
+
+class BlockRandom:
+    """
+    Random integers from a block-buffered byte source
+    """
+
+    def __init__(self, source: Callable[[int], bytes],
+                 block_size: int = BLOCK_SIZE):
+        self.source = source
+        self.block_size = block_size
+        self._buffer = b''
+        self._pos = 0
+
+    def _refill(self):
+        self._buffer = self.source(self.block_size)
+        self._pos = 0
+
+    def _byte(self) -> int:
+        if self._pos >= len(self._buffer):
+            self._refill()
+        byte = self._buffer[self._pos]
+        self._pos += 1
+        return byte
+
+    def _uint(self, size: int) -> int:
+        if self._pos + size > len(self._buffer):
+            self._refill()
+        value = int.from_bytes(
+            self._buffer[self._pos:self._pos + size], 'little')
+        self._pos += size
+        return value
+
+    def randint(self, low: int, high: int) -> int:
+        """
+        Random integer N such that low <= N <= high
+        """
+        span = high - low + 1
+        if span < 1:
+            raise ValueError(f'Empty range: {low}..{high}')
+        if span == 1:
+            return low
+        if span <= 256:
+            limit = 256 - 256 % span
+            while True:
+                byte = self._byte()
+                if byte < limit:
+                    return low + byte % span
+        size = (span.bit_length() + 7) // 8
+        top = 1 << (8 * size)
+        limit = top - top % span
+        while True:
+            value = self._uint(size)
+            if value < limit:
+                return low + value % span
+
+    def faces(self, sides: int, number: int) -> List[int]:
+        """
+        Roll `number` dices with `sides` sides
+        """
+        if sides < 1:
+            raise ValueError(f'A dice cannot have {sides} sides')
+        if sides == 1:
+            return [1] * number
+        if sides > 65536:
+            return [self.randint(1, sides) for _ in range(number)]
+        size = 1 if sides <= 256 else 2
+        top = 1 << (8 * size)
+        limit = top - top % sides
+        result = []
+        while len(result) < number:
+            if self._pos + size > len(self._buffer):
+                self._refill()
+            available = len(self._buffer) - self._pos
+            end = self._pos + min(
+                (number - len(result)) * size, available - available % size)
+            chunk = memoryview(self._buffer)[self._pos:end]
+            self._pos = end
+            if size == 2:
+                chunk = chunk.cast('H')
+            result.extend(
+                value % sides + 1 for value in chunk if value < limit)
+        return result
+
+
+def make_source(name: str, seed: Union[int, str] = None
+                ) -> Callable[[int], bytes]:
+    """
+    Byte source by name: prng (seedable Mersenne Twister),
+    urandom (os.urandom) or secrets (secrets.token_bytes)
+    """
+    if name == 'prng':
+        generator = random.Random(seed)
+        return generator.randbytes
+    if name == 'urandom':
+        return os.urandom
+    if name == 'secrets':
+        return secrets.token_bytes
+    raise ValueError(f'Unknown random source: {name}. Use one of {SOURCES}')
+
+
+class StreamFactory:
+    """
+    Hands out a BlockRandom per thread. With a seed the n-th stream
+    created gets seed + n, so runs with the same thread order repeat.
+    Streams are not inherited by forked worker processes, and their
+    seeds are mixed with the pid: workers forked from one master
+    (gunicorn, forkserver) would draw the same faces otherwise.
+    """
+
+    def __init__(self, source: str = 'prng', seed: int = None,
+                 block_size: int = BLOCK_SIZE):
+        make_source(source, seed)  # fail early on unknown source
+        self.source = source
+        self.seed = seed
+        self.block_size = block_size
+        self._local = threading.local()
+        self._counter = count()
+        self._pid = os.getpid()
+
+    def stream(self) -> BlockRandom:
+        rng = getattr(self._local, 'rng', None)
+        if rng is None or self._local.pid != os.getpid():
+            seed = None
+            if self.seed is not None:
+                seed = self.seed + next(self._counter)
+                if os.getpid() != self._pid:
+                    seed = f'{seed}-{os.getpid()}'
+            rng = BlockRandom(
+                make_source(self.source, seed), self.block_size)
+            self._local.rng = rng
+            self._local.pid = os.getpid()
+        return rng
+
+
+def _seed_from_env():
+    seed = os.environ.get('DICE_RNG_SEED')
+    return int(seed) if seed else None
+
+
+_factory = StreamFactory(
+    os.environ.get('DICE_RNG', 'prng'), _seed_from_env())
+
+
+def configure(source: str = 'prng', seed: int = None,
+              block_size: int = BLOCK_SIZE):
+    """
+    Replace streams of all threads, e.g. with a seeded one for tests
+    """
+    global _factory
+    _factory = StreamFactory(source, seed, block_size)
+
+
+def get_stream() -> BlockRandom:
+    """
+    Random stream of the current thread
+    """
+    return _factory.stream()
@@ -0,0 +1,285 @@
+"""
+Load shaping helpers for handlers
+"""
+
+import os
+import time
+import logging
+import sqlite3
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+throttlinglogger = logging.getLogger('throttlinglogger')
+
+
+class Debouncer:
+    """
+    Runs only the latest of quickly repeated calls per key. Telegram
+    sends an inline query on every keystroke; a call runs `delay`
+    seconds later, unless a newer call with the same key replaced it
+    meanwhile. Callers never wait: calls are scheduled by a timer
+    thread and run in `workers` threads of the debouncer.
+    """
+
+    def __init__(self, delay: float = 0.4, workers: int = 2):
+        self.delay = delay
+        self.workers = workers
+        self._pending = {}          # key -> (due, func, args)
+        self._running = set()
+        self._lock = threading.Condition()
+        self._timer = None
+        self._executor = None
+
+    def call(self, key, func, *args):
+        """
+        Schedule func(*args) in place of the pending call with the key
+        """
+        with self._lock:
+            if self._timer is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix='debounced')
+                self._timer = threading.Thread(
+                    target=self._schedule, name='debouncer', daemon=True)
+                self._timer.start()
+            self._pending[key] = (time.monotonic() + self.delay, func, args)
+            self._lock.notify()
+
+    def drain(self, timeout: float) -> int:
+        """
+        Run pending calls at once and wait up to timeout seconds for
+        them, return how many did not finish
+        """
+        with self._lock:
+            for key, (_, func, args) in self._pending.items():
+                self._pending[key] = (0.0, func, args)
+            self._lock.notify()
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                left = len(self._pending) + len(self._running)
+            if not left or time.monotonic() >= deadline:
+                return left
+            time.sleep(0.05)
+
+    def _schedule(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                due = [key for key, (moment, _, _) in self._pending.items()
+                       if moment <= now]
+                if not due:
+                    wait = min(
+                        (moment for moment, _, _ in self._pending.values()),
+                        default=now + 60)
+                    self._lock.wait(wait - now)
+                    continue
+                for key in due:
+                    _, func, args = self._pending.pop(key)
+                    future = self._executor.submit(func, *args)
+                    self._running.add(future)
+                    future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self._lock:
+            self._running.discard(future)
+        if future.exception() is not None:
+            throttlinglogger.error(
+                'Debounced call failed: %s', future.exception())
+
+
+# a token bucket check: take cost tokens from bucket key
+Bucket = namedtuple('Bucket', ['key', 'cost', 'rate', 'capacity'])
+
+# how often stores drop buckets which are full again, seconds
+SWEEP_INTERVAL = 60.0
+
+
+def refill(tokens: float, updated: float, now: float, rate: float,
+           capacity: float) -> float:
+    return min(capacity, tokens + (now - updated) * rate)
+
+
+def refill_time(buckets: list) -> float:
+    """
+    Seconds the slowest of the buckets takes to refill from empty: a
+    bucket untouched for longer is full, the same as a missing one
+    """
+    return max(
+        (bucket.capacity / bucket.rate if bucket.rate > 0 else float('inf')
+         for bucket in buckets), default=0.0)
+
+
+class MemoryBucketStore:
+    """
+    Token buckets of a single process. Buckets of users and chats
+    which went quiet are dropped once they are full again.
+    """
+
+    def __init__(self):
+        self._buckets = {}          # key -> (tokens, updated)
+        self._lock = threading.Lock()
+        self._refill_time = 0.0
+        self._swept = time.time()
+
+    def take(self, buckets: list, now: float = None) -> bool:
+        """
+        Take tokens from all the buckets, or from none of them if any
+        of them runs dry
+        """
+        now = now or time.time()
+        with self._lock:
+            levels = []
+            for key, cost, rate, capacity in buckets:
+                tokens, updated = self._buckets.get(key, (capacity, now))
+                tokens = refill(tokens, updated, now, rate, capacity)
+                if tokens < cost:
+                    return False
+                levels.append((key, tokens - cost))
+            for key, tokens in levels:
+                self._buckets[key] = (tokens, now)
+            self._refill_time = max(self._refill_time, refill_time(buckets))
+            if now - self._swept > SWEEP_INTERVAL:
+                self._swept = now
+                border = now - self._refill_time
+                self._buckets = {
+                    key: level for key, level in self._buckets.items()
+                    if level[1] >= border
+                }
+            return True
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class SQLiteBucketStore:
+    """
+    Token buckets in a local SQLite file, shared by all worker processes
+    of the box. Any store error lets the update through. Buckets which
+    are full again are deleted now and then.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._refill_time = 0.0
+        self._swept = time.time()
+        with self._connection() as con:
+            con.execute(
+                'CREATE TABLE IF NOT EXISTS buckets '
+                '(key TEXT PRIMARY KEY, tokens REAL, updated REAL)'
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        con = getattr(self._local, 'con', None)
+        if con is None or self._local.pid != os.getpid():
+            con = sqlite3.connect(
+                self.path, timeout=1.0, isolation_level=None)
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('PRAGMA synchronous=OFF')
+            self._local.con = con
+            self._local.pid = os.getpid()
+        return con
+
+    def take(self, buckets: list, now: float = None) -> bool:
+        now = now or time.time()
+        try:
+            con = self._connection()
+            con.execute('BEGIN IMMEDIATE')
+            try:
+                levels = []
+                for key, cost, rate, capacity in buckets:
+                    row = con.execute(
+                        'SELECT tokens, updated FROM buckets WHERE key = ?',
+                        (key,)
+                    ).fetchone()
+                    tokens, updated = row or (capacity, now)
+                    tokens = refill(tokens, updated, now, rate, capacity)
+                    if tokens < cost:
+                        return False
+                    levels.append((key, tokens - cost, now))
+                con.executemany(
+                    'INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)', levels)
+                self._refill_time = max(
+                    self._refill_time, refill_time(buckets))
+                if now - self._swept > SWEEP_INTERVAL:
+                    self._swept = now
+                    con.execute(
+                        'DELETE FROM buckets WHERE updated < ?',
+                        (now - self._refill_time,))
+                return True
+            finally:
+                con.execute('COMMIT')
+        except sqlite3.Error as exc:
+            throttlinglogger.warning('Bucket store failed: %s', exc)
+            return True
+
+
+class AdmissionController:
+    """
+    Token buckets per user and per chat in front of handlers. Every
+    command costs some tokens (COMMAND_COSTS, 1 by default); buckets
+    refill with a constant rate up to their burst size.
+    """
+
+    COMMAND_COSTS = {
+        'stats': 5,
+        'odds': 3,
+        'history': 3,
+        # every keystroke is a query, and only the last one is answered
+        'inline': 0.1,
+    }
+
+    def __init__(self, store=None, user_rate: float = 1.0,
+                 user_burst: float = 10.0, chat_rate: float = 3.0,
+                 chat_burst: float = 30.0, costs: dict = None):
+        self.store = store or MemoryBucketStore()
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.costs = dict(self.COMMAND_COSTS, **(costs or {}))
+        self._warned = {}
+
+    @classmethod
+    def from_env(cls):
+        """
+        Settings from ADMISSION_* system vars. ADMISSION_STORE is a path
+        to SQLite file shared by workers, in-process buckets if not set.
+        """
+        path = os.environ.get('ADMISSION_STORE')
+        return cls(
+            store=SQLiteBucketStore(path) if path else None,
+            user_rate=float(os.environ.get('ADMISSION_USER_RATE', 1.0)),
+            user_burst=float(os.environ.get('ADMISSION_USER_BURST', 10.0)),
+            chat_rate=float(os.environ.get('ADMISSION_CHAT_RATE', 3.0)),
+            chat_burst=float(os.environ.get('ADMISSION_CHAT_BURST', 30.0)),
+        )
+
+    def admit(self, command: str, user_id: int, chat_id: int = None) -> bool:
+        cost = self.costs.get(command, 1)
+        buckets = [Bucket(
+            f'u{user_id}', min(cost, self.user_burst), self.user_rate,
+            self.user_burst
+        )]
+        if chat_id is not None and chat_id != user_id:
+            buckets.append(Bucket(
+                f'c{chat_id}', min(cost, self.chat_burst), self.chat_rate,
+                self.chat_burst
+            ))
+        return self.store.take(buckets)
+
+    def should_warn(self, user_id: int, interval: float = 30.0) -> bool:
+        """
+        Whether a throttled user should get a "slow down" reply:
+        at most once per interval, later updates are dropped silently
+        """
+        now = time.monotonic()
+        if now - self._warned.get(user_id, -interval) < interval:
+            return False
+        if len(self._warned) > 10000:
+            self._warned.clear()
+        self._warned[user_id] = now
+        return True
@@ -0,0 +1,34 @@
+"""
+Gunicorn settings with worker lifecycle hooks: a new worker warms up
+before it takes updates, and a stopping worker (SIGTERM on deploy or
+restart) finishes the updates it took and stores buffered writes
+within graceful_timeout.
+
+Restart without downtime: `kill -HUP <master pid>` starts new workers
+with the new code, and the old ones are stopped gracefully.
+"""
+
+import os
+import sys
+
+
+# seconds a stopping worker has to drain; Heroku kills in 30 seconds
+graceful_timeout = int(os.environ.get('DRAIN_TIMEOUT', 25))
+
+
+def post_worker_init(worker):
+    # other apps, like router.py, have nothing to warm up
+    bot_app = sys.modules.get('wsgi')
+    if bot_app is None:
+        return
+    try:
+        bot_app.warm_up()
+    except Exception as exc:
+        worker.log.warning('Warming up failed: %s', exc)
+
+
+def worker_exit(server, worker):
+    bot_app = sys.modules.get('wsgi')
+    if bot_app is not None:
+        # leave a second to exit before the master kills the worker
+        bot_app.drain(max(graceful_timeout - 1, 1))
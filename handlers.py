@@ -1,21 +1,61 @@
+import os
+import time
 import functools
 import logging
+import tempfile
+import threading
 
 from flask import current_app
 from pony.orm import db_session
+from telebot import types
 
+import odds
+import sheets
 import views
-from roller import DiceRoller
-from models import User, Roll
+from roller import DiceRoller, FormulaError
+from models import User, Char, Party, Roll, RollRecord, cached_stats
+from common.database import (
+    UNAVAILABLE_ERRORS, query_timeout, read_only_session)
+from common.analysis import AnalysisError, analyzer
+from common.background import writer
+from common.cache import TTLCache
+from common.metrics import counters
+from common.throttling import AdmissionController, Debouncer
 from common.unicode import emoji
 
 
+# send full list of faces as a document when a roll is rendered compactly
+ROLL_FACES_DOCUMENT = os.environ.get('ROLL_FACES_DOCUMENT', '1') == '1'
+
+# inline mode: how long Telegram may cache answers, seconds
+INLINE_HELP_CACHE_TIME = 3600
+INLINE_MENU_CACHE_TIME = 300
+
+# saved throws of users for the inline menu, user_id -> [(name, formula)]
+inline_throws = TTLCache(ttl=60)
+# active chars of users to roll with while the database is unavailable,
+# user_id -> (taken, CharSnapshot); refreshed by rolls now and then
+char_snapshots = TTLCache(ttl=86400)
+CHAR_SNAPSHOT_REFRESH = 600
+# longer sheets are sent as a file
+SHEET_MESSAGE_LIMIT = 3500
+# callback data of the button under a change confirmation: chars:<user_id>
+CHARLIST_CALLBACK = 'chars'
+# statement timeout for char lookups of rolls, ms
+ROLL_QUERY_TIMEOUT = int(os.environ.get('ROLL_QUERY_TIMEOUT', 1000))
+inline_debouncer = Debouncer(delay=0.4)
+
+admission = AdmissionController.from_env()
+
 # getting data from flask.app_context
 app = current_app
 with app.app_context():
     bot = app.config['TELEBOT']
     botlogger = app.config['TELEBOT_LOGGER']
 
+# the bot which got the update handled by the thread, see admitted()
+current = threading.local()
+
 
 class BotHandlers:
     """
@@ -23,21 +63,27 @@ class BotHandlers:
     For use only within app.app_context.
 
     Every single handler function should be decorated
-    with custom @handler decorator.
+    with custom @handler decorator. Handlers of other updates than
+    messages are marked with kind: @handler(kind='inline', ...)
     """
 
     handlers = []
 
     @classmethod
-    def register(cls):
+    def register(cls, target: object = None, number: int = 0):
         """
-        Register message handlers defined below into a TeleBot.
+        Register message handlers defined below into a TeleBot
+        (the one of the app by default). When an app hosts several
+        bots, number tells them apart in metrics.
         """
+        target = target or bot
         try:
             for handler in BotHandlers.handlers:
                 name = handler[0]
-                kwargs = handler[1]
-                bot.register_message_handler(name, **kwargs)
+                kwargs = dict(handler[1])
+                kind = kwargs.pop('kind', 'message')
+                getattr(target, f'register_{kind}_handler')(
+                    admitted(name, kind, target, number), **kwargs)
             return True
         except Exception as exc:
             logging.error('Cannot register handlers: %s', exc)
@@ -99,9 +145,9 @@ class BotHandlers:
     @handler(append_to=handlers, commands=['stats'])
     def send_stats(message):
         """
-        Bot sends statistics
+        Bot sends statistics (from the shared snapshot, not the database)
         """
-        send(message, views.statistics(Roll.get_stats()))
+        send(message, views.statistics(cached_stats()))
 
     @handler(append_to=handlers, commands=['info'])
     def send_info(message):
@@ -114,12 +160,12 @@ class BotHandlers:
     # Managing user settings handlers
     #
     @handler(append_to=handlers, commands=['char', 'chars'])
-    @db_session
-    @with_info
-    def show_user_chars_list(message, user, char):
+    @read_only_session()
+    def show_user_chars_list(message):
         """
-        Show charlist for user
+        Show charlist for user. Read-only, may be served by the replica
         """
+        user = User.get(user_id=message.from_user.id)
         reply(message, views.charlist(user))
 
     @handler(append_to=handlers, commands=['createchar'])
@@ -133,6 +179,7 @@ class BotHandlers:
         if not charname:
             send(message, views.command_help('/createchar'))
             return
+        forget_char(user.user_id)
         try:
             newchar = user.create_char(charname)
         except Exception as exc:
@@ -157,6 +204,7 @@ class BotHandlers:
             # charname should be a single word
             reply(message, views.command_help('deletechar'))
             return
+        forget_char(user.user_id)
         try:
             user.delete_char(name=charname)
         except Exception as exc:
@@ -179,12 +227,14 @@ class BotHandlers:
         if not charname:
             reply(message, views.command_help('activechar'))
             return
+        forget_char(user.user_id)
         try:
             user.set_active_char(charname)
         except Exception as exc:
             reply(message, views.error(exc))
         else:
-            reply(message, views.charlist(user))
+            reply(message, views.char_activated(charname),
+                  charlist_button(user.user_id))
 
     @handler(append_to=handlers, commands=['createroll'])
     @db_session
@@ -206,12 +256,14 @@ class BotHandlers:
         if not char:
             reply(message, views.error('You have not a char yet.'))
             return
+        forget_char(user.user_id)
         try:
             char.create_throw(throw_name, formula)
         except Exception as exc:
             reply(message, views.error(exc))
         else:
-            reply(message, views.charlist(user))
+            reply(message, views.throw_changed(char.name, throw_name, formula),
+                  charlist_button(user.user_id))
 
     @handler(append_to=handlers, commands=['deleteroll', 'deletethrow'])
     @db_session
@@ -227,12 +279,14 @@ class BotHandlers:
         if not char:
             reply(message, views.error('You have no chars. Use /createchar'))
             return
+        forget_char(user.user_id)
         try:
             char.delete_throw(throw_name)
         except Exception as exc:
             reply(message, views.error(exc))
         else:
-            reply(message, views.charlist(user))
+            reply(message, views.throw_changed(char.name, throw_name),
+                  charlist_button(user.user_id))
 
     @handler(append_to=handlers, commands=['addmod'])
     @db_session
@@ -257,13 +311,14 @@ class BotHandlers:
         if not char:
             reply(message, views.error('You have no chars. Use /createchar'))
             return
-
+        forget_char(user.user_id)
         try:
-            char.create_attribute(name, alias, value, mod)
+            attr = char.create_attribute(name, alias, value, mod)
         except Exception as exc:
             reply(message, views.error(exc))
         else:
-            reply(message, views.charlist(user))
+            reply(message, views.attribute_changed(char.name, name, attr),
+                  charlist_button(user.user_id))
 
     @handler(append_to=handlers, commands=['deletemod'])
     @db_session
@@ -276,18 +331,76 @@ class BotHandlers:
         if not char:
             reply(message, views.error('You have not a char yet. /createchar'))
             return
+        forget_char(user.user_id)
         try:
             char.delete_attribute(name)
         except Exception as exc:
             reply(message, views.error(exc))
         else:
-            reply(message, views.charlist(user))
+            reply(message, views.attribute_changed(char.name, name),
+                  charlist_button(user.user_id))
+
+    @handler(append_to=handlers, commands=['exportchar'])
+    @db_session
+    @with_info
+    def export_char(message, user, char):
+        """
+        Send a char sheet: /exportchar [CharName] [json]
+        """
+        args = message.text[11:].split()
+        as_json = bool(args) and args[-1].lower() == 'json'
+        if as_json:
+            args = args[:-1]
+        if args:
+            charname = args[0]
+            char = user.chars.filter(lambda x: x.name == charname).get()
+        if not char:
+            reply(message, views.command_help(
+                'exportchar', 'No such char. Check your /chars'))
+            return
+        sheet = sheets.CharSheet.of(char)
+        text = sheet.as_json() if as_json else sheet.as_text()
+        if len(text) > SHEET_MESSAGE_LIMIT:
+            send_document(
+                message, [text],
+                f'{char.name}.{"json" if as_json else "txt"}', as_reply=True)
+        else:
+            reply(message, views.sheet(text))
+
+    @handler(append_to=handlers, commands=['importchar'])
+    def import_char(message):
+        """
+        Create a char (or add to the char with the same name) from
+        a sheet after the command or in the message replied to
+        """
+        text = message.text[11:].strip()
+        if not text and message.reply_to_message:
+            text = (message.reply_to_message.text or '').strip()
+        if not text:
+            reply(message, views.command_help('importchar'))
+            return
+        try:
+            sheet = sheets.parse(text)
+        except sheets.SheetError as exc:
+            reply(message, views.sheet_errors(exc.errors))
+            return
+        user_id = message.from_user.id
+        forget_char(user_id)
+        try:
+            with db_session:
+                user = User.get_user_by_id(user_id)
+                _, created = user.import_char(sheet)
+        except UNAVAILABLE_ERRORS:
+            raise
+        except Exception as exc:
+            reply(message, views.error(exc))
+        else:
+            reply(message, views.sheet_imported(sheet, created))
 
     #
     # Rolls handlers
     #
     @handler(append_to=handlers, commands=['roll'])
-    @db_session
     def roll_anything(message):
         """
         Answering to the /roll command
@@ -297,27 +410,36 @@ class BotHandlers:
         if not raw_formula:
             send(message, views.command_help('/roll'))
             return
-        roller = DiceRoller(raw_formula, telegram_user)
+        roller = roller_for(raw_formula, telegram_user)
         hand = roller.hand
-        Roll.register()
-        reply(message, views.roll(roller, hand))
+        register_roll(roller, hand)
+        reply_roll(message, roller, hand)
 
     @handler(append_to=handlers, commands=['rollme'])
-    @db_session
-    @with_info
-    def roll_custom_throw(message, user, char):
+    def roll_custom_throw(message):
         """
         Rolling pre-defined throws by name
         """
-        if not char:
-            reply(message, views.error('You have not a char yet. /createchar'))
-            return
         query = message.text[7:].strip().split()
         if not len(query):
             reply(message, views.command_help('rollme'))
+            return
 
         throwname = query[0]              # first arg would be the throwname
-        formula = char.throw(throwname)   # naked formula
+        try:
+            with query_timeout(ROLL_QUERY_TIMEOUT):
+                charname, formula = Char.active_throw(   # naked formula
+                    message.from_user.id, throwname)
+        except UNAVAILABLE_ERRORS:
+            charname, formula = None, ''
+            snapshot = cached_char(message.from_user.id)
+            if snapshot:
+                charname, formula = snapshot.name, snapshot.throw(throwname)
+            else:
+                raise
+        if not charname:
+            reply(message, views.error('You have not a char yet. /createchar'))
+            return
 
         if len(query) > 1:
             # got some addition to the Throw, like "/rollme throwname + 2"
@@ -328,17 +450,165 @@ class BotHandlers:
             addition = ''
 
         if formula:
-            roller = DiceRoller(formula + addition, message.from_user)
+            roller = roller_for(formula + addition, message.from_user)
             hand = roller.hand
-            Roll.register()
-            reply(message, views.roll(roller, hand))
+            register_roll(roller, hand)
+            reply_roll(message, roller, hand)
         else:
             error_text = (
                 f'Sorry, such Throw ({throwname}) is not '
-                f'registered for your active char {char.name}'
+                f'registered for your active char {charname}'
             )
             reply(message, views.error(error_text))
 
+    @handler(append_to=handlers, commands=['odds'])
+    def show_odds(message):
+        """
+        Exact odds of a formula, without rolling it. Heavy formulas are
+        computed in the analysis pool, not in the request thread.
+        """
+        raw_formula = message.text[6:]  # removeprefix /odds
+        if not raw_formula.strip():
+            send(message, views.command_help('odds'))
+            return
+        with db_session:
+            roller = DiceRoller(raw_formula, message.from_user)
+            spec = odds.hand_spec(roller.parse())
+        try:
+            distribution = analyzer.run(
+                ('odds', spec), odds.spec_distribution, spec)
+        except (odds.OddsTooComplex, AnalysisError) as exc:
+            reply(message, views.error(exc))
+        else:
+            reply(message, views.odds(roller, distribution))
+
+    @handler(append_to=handlers, commands=['history'])
+    @with_info
+    def show_history(message, user, char):
+        """
+        Show, switch on/off or export roll history of the active char
+        """
+        if not char:
+            reply(message, views.error('You have not a char yet. /createchar'))
+            return
+        option = message.text[9:].strip().lower()
+        if option in ('on', 'off'):
+            Char.switch_history(char.id, option == 'on')
+            reply(message, views.history_switched(char.name, option == 'on'))
+        elif option in ('csv', 'json'):
+            send_document(
+                message,
+                RollRecord.iter_export(char.id, option),
+                f'{char.name}_history.{option}'
+            )
+        elif option:
+            error_text = f'Unknown option: {option}'
+            reply(message, views.command_help('history', error_text))
+        else:
+            reply(message, views.history(
+                char.name, char.history, RollRecord.latest(char.id)))
+
+    #
+    # Party rolls
+    #
+    @handler(append_to=handlers, commands=['joinparty'])
+    @db_session
+    @with_info
+    def join_party(message, user, char):
+        """
+        Add the active char to the party of this chat
+        """
+        if not char:
+            reply(message, views.error('You have not a char yet. /createchar'))
+            return
+        try:
+            Party.join(message.chat.id, char)
+        except Exception as exc:
+            reply(message, views.error(exc))
+        else:
+            reply(message, f'{emoji["elf"]} {char.name} joined the party.')
+
+    @handler(append_to=handlers, commands=['leaveparty'])
+    def leave_party(message):
+        """
+        Remove all chars of the user from the party of this chat
+        """
+        names = Party.leave(message.chat.id, message.from_user.id)
+        if names:
+            reply(message, f'{", ".join(names)} left the party.')
+        else:
+            reply(message, views.error('You have no chars in this party.'))
+
+    @handler(append_to=handlers, commands=['party'])
+    def roll_party(message):
+        """
+        Roll a Throw (by name) or a formula for every char of the party
+        at once, e.g. "/party Initiative" or "/party d20 + $DEX"
+        """
+        members = Party.members(message.chat.id)
+        text = message.text[6:].strip()  # removeprefix /party
+        if not text:
+            reply(message, views.party_members(members))
+            return
+        if not members:
+            reply(message, views.command_help(
+                'party', 'Nobody has joined the party yet.'))
+            return
+        rolls, skipped = party_rolls(message.from_user, members, text)
+        Roll.register(len(rolls))
+        for roller, hand in rolls:
+            if roller.char.history:
+                writer.submit(
+                    RollRecord.store, roller.char.id, roller.formula.strip(),
+                    **RollRecord.packed(hand)
+                )
+        reply(message, views.party(rolls, skipped, text))
+
+    #
+    # Inline mode
+    #
+    @handler(append_to=handlers, kind='inline', func=lambda query: True)
+    def answer_inline(query):
+        """
+        Inline mode: "@bot 2d20 + 3" rolls a formula, "@bot MyThrow + 1"
+        rolls a saved throw, empty query shows saved throws and help
+        """
+        text = query.query.strip()
+        if text.lower() == 'help':
+            current_bot().answer_inline_query(
+                query.id, [inline_help_card()],
+                cache_time=INLINE_HELP_CACHE_TIME, is_personal=False)
+            return
+        # answer only the query the user stopped typing at, later and
+        # off the update thread
+        inline_debouncer.call(
+            (current_bot(), query.from_user.id), inline_answer,
+            current_bot(), query)
+
+    #
+    # Inline buttons
+    #
+    @handler(append_to=handlers, kind='callback_query',
+             func=lambda call: (call.data or '').startswith(
+                 f'{CHARLIST_CALLBACK}:'))
+    @read_only_session()
+    def show_chars_on_demand(call):
+        """
+        Replace a change confirmation with the full charlist when its
+        owner asks for it, see charlist_button()
+        """
+        owner = call.data.partition(':')[2]
+        if str(call.from_user.id) != owner:
+            current_bot().answer_callback_query(
+                call.id, 'Only the owner of these chars can open them')
+            return
+        user = User.get(user_id=call.from_user.id)
+        current_bot().answer_callback_query(call.id)
+        current_bot().edit_message_text(
+            views.charlist(user), call.message.chat.id,
+            call.message.message_id, parse_mode='HTML'
+        )
+
     #
     # Roll shorthands commands
     #
@@ -372,7 +642,7 @@ class BotHandlers:
 # HELPER FUNCTIONS
 #
 #
-def reply(to_message: object, with_message: str):
+def reply(to_message: object, with_message: str, markup: object = None):
     """
     Reply to given incoming message with outcoming message
     (with Telegram reply wrapper).
@@ -381,11 +651,13 @@ def reply(to_message: object, with_message: str):
           came to bot from user
     * with_message: answer the bot should send to
           the author of incoming_message
+    * markup: optional keyboard under the answer
     """
-    bot.reply_to(
+    current_bot().reply_to(
             to_message,
             with_message,
-            parse_mode='HTML'
+            parse_mode='HTML',
+            reply_markup=markup
         )
 
 
@@ -398,13 +670,288 @@ def send(incoming_message: object, outcoming_message: str):
     * outcoming_message: answer the bot should send to
           the author of incoming_message
     """
-    bot.send_message(
+    current_bot().send_message(
         incoming_message.from_user.id,
         outcoming_message,
         parse_mode='HTML'
     )
 
 
+def send_document(incoming_message: object, chunks, filename: str,
+                  as_reply: bool = False):
+    """
+    Send text document built from chunks (any iterable of strings) to
+    the author of incoming_message, or as a reply into its chat.
+    The text is spooled to a temporary file, so it is never kept
+    in memory as a whole.
+    """
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as document:
+        for chunk in chunks:
+            document.write(chunk.encode('utf-8'))
+        document.seek(0)
+        if as_reply:
+            current_bot().send_document(
+                incoming_message.chat.id,
+                document,
+                reply_to_message_id=incoming_message.message_id,
+                visible_file_name=filename
+            )
+        else:
+            current_bot().send_document(
+                incoming_message.from_user.id,
+                document,
+                visible_file_name=filename
+            )
+
+
+def charlist_button(user_id: int) -> types.InlineKeyboardMarkup:
+    """
+    Button opening the full charlist of the user, so that changes are
+    confirmed briefly and the whole list is rendered only on demand
+    """
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton(
+        f'{emoji["elf"]} All chars',
+        callback_data=f'{CHARLIST_CALLBACK}:{user_id}'))
+    return markup
+
+
+def reply_roll(to_message: object, roller: DiceRoller, hand: object):
+    """
+    Reply with the rendered roll. Huge dice groups (or all the groups
+    of a huge formula) are rendered compactly; their faces may follow
+    as a text document.
+    """
+    reply(to_message, views.roll(roller, hand))
+    if ROLL_FACES_DOCUMENT and (views.compact_groups(hand)
+                                or views.roll_collapsed(roller, hand)):
+        send_document(
+            to_message, views.roll_faces(roller, hand), 'roll.txt',
+            as_reply=True
+        )
+
+
+def roller_for(formula: str, telegram_user: object) -> DiceRoller:
+    """
+    DiceRoller with a rolled hand for the active char of the user.
+    Char lookups have a short timeout; if the database is unavailable
+    the roll is made offline with the saved snapshot of the char.
+    """
+    try:
+        with query_timeout(ROLL_QUERY_TIMEOUT), db_session:
+            roller = DiceRoller(formula, telegram_user)
+            roller.hand
+            remember_char(telegram_user.id, roller.char)
+        return roller
+    except UNAVAILABLE_ERRORS as exc:
+        botlogger.warning(
+            'Rolling offline for user %s: %s', telegram_user.id, exc)
+    roller = DiceRoller(
+        formula, telegram_user, char=cached_char(telegram_user.id),
+        offline=True)
+    roller.hand
+    return roller
+
+
+def remember_char(user_id: int, char: Char):
+    """
+    Keep a snapshot of user's active char for offline rolls, refreshed
+    once in CHAR_SNAPSHOT_REFRESH seconds. Called within db_session.
+    """
+    if char is None:
+        char_snapshots.pop(user_id)
+        return
+    taken, _ = char_snapshots.get(user_id, (0.0, None))
+    if time.monotonic() - taken > CHAR_SNAPSHOT_REFRESH:
+        char_snapshots.set(user_id, (time.monotonic(), char.snapshot()))
+
+
+def cached_char(user_id: int):
+    """
+    Saved snapshot of user's active char, None if there is none
+    """
+    return char_snapshots.get(user_id, (0.0, None))[1]
+
+
+def forget_char(user_id: int):
+    """
+    Drop cached data of user's chars after they are changed
+    """
+    inline_throws.pop(user_id)
+    char_snapshots.pop(user_id)
+
+
+def register_roll(roller: DiceRoller, hand: object):
+    """
+    Count the roll and, if the char keeps roll history, queue
+    the history record to be written in background
+    """
+    Roll.register()
+    char = roller.char
+    if char and char.history:
+        writer.submit(
+            RollRecord.store, char.id, roller.formula.strip(),
+            **RollRecord.packed(hand)
+        )
+
+
+def party_rolls(telegram_user: object, members: list, text: str) -> tuple:
+    """
+    Roll for all party chars (snapshots, so no database is touched).
+    If the first word is a Throw name of any char, the Throw is rolled
+    (with the rest as an addition) and chars without it are skipped;
+    otherwise the whole text is rolled as a formula.
+    Returns (roller, hand) pairs sorted by result and skipped chars.
+    """
+    name, _, addition = text.partition(' ')
+    by_throw = any(char.throw(name) for char in members)
+    rolls, skipped = [], []
+    for char in members:
+        formula = text
+        if by_throw:
+            formula = char.throw(name)
+            if not formula:
+                skipped.append(char)
+                continue
+            formula = f'{formula} {addition}'.strip()
+        roller = DiceRoller(formula, telegram_user, char=char)
+        rolls.append((roller, roller.hand))
+    rolls.sort(key=lambda pair: pair[1].result, reverse=True)
+    return rolls, skipped
+
+
+def command_of(message: object) -> str:
+    """
+    Command name of a message: "/roll@SomeBot 2d6" -> "roll"
+    """
+    text = getattr(message, 'text', None) or ''
+    if not text.startswith('/'):
+        return ''
+    return text.split(maxsplit=1)[0][1:].split('@')[0].lower()
+
+
+def current_bot() -> object:
+    """
+    The bot which got the update being handled
+    """
+    return getattr(current, 'bot', None) or bot
+
+
+def admitted(func, kind: str = 'message', target: object = None,
+             number: int = 0):
+    """
+    Wrap a handler with admission control: once user's or chat's token
+    bucket runs dry, the user gets a "slow down" reply (at most once in
+    a while) and further updates are dropped. Replies of the handler
+    go through the target bot.
+    """
+    @functools.wraps(func)
+    def wrapper_admitted(update, *args, **kwargs):
+        current.bot = target
+        user_id = update.from_user.id
+        if kind == 'message':
+            command, chat_id = command_of(update), update.chat.id
+        else:
+            command, chat_id = kind, None
+        if admission.admit(command, user_id, chat_id):
+            started = time.perf_counter()
+            try:
+                return func(update, *args, **kwargs)
+            except UNAVAILABLE_ERRORS as exc:
+                # breaker is open or the database is too slow: fail fast
+                botlogger.warning('%s failed, database unavailable: %s',
+                                  command or kind, exc)
+                if kind == 'message':
+                    reply(update, views.unavailable())
+                return None
+            except FormulaError as exc:
+                if kind == 'message':
+                    reply(update, views.error(exc))
+                return None
+            finally:
+                counters.count_command(
+                    command or kind, time.perf_counter() - started, number)
+        counters.count_command('throttled', 0, number)
+        botlogger.info('Throttled %s of user %s', command, user_id)
+        if kind == 'message' and admission.should_warn(user_id):
+            reply(update, views.slow_down())
+    return wrapper_admitted
+
+
+def inline_answer(target: object, query: object):
+    """
+    Answer an inline query of the bot (target) with rolls of the query
+    text or with saved throws, see BotHandlers.answer_inline()
+    """
+    current.bot = target
+    text = query.query.strip()
+    user_id = query.from_user.id
+    try:
+        with query_timeout(ROLL_QUERY_TIMEOUT):
+            throws = inline_throws.get_or_set(
+                user_id, lambda: Char.active_throws(user_id))
+    except UNAVAILABLE_ERRORS:
+        snapshot = cached_char(user_id)
+        throws = list(snapshot.throws.items()) if snapshot else []
+    results = []
+    if text:
+        name, _, addition = text.partition(' ')
+        formula = dict(throws).get(name)
+        if formula:
+            results.append(inline_roll(
+                query, f'{formula} {addition}'.strip(), name))
+        else:
+            results.append(inline_roll(query, text))
+    else:
+        results = [
+            inline_roll(query, formula, name) for name, formula in throws
+        ]
+    results = [result for result in results if result]
+    results.append(inline_help_card())
+    current_bot().answer_inline_query(
+        query.id, results,
+        # rolled results must never be reused by Telegram
+        cache_time=0 if len(results) > 1 else INLINE_MENU_CACHE_TIME,
+        is_personal=True
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def inline_help_card():
+    """
+    Static inline result with the inline mode help
+    """
+    return types.InlineQueryResultArticle(
+        id='help',
+        title='How to roll inline',
+        description='Type a formula like 2d20 + 3 or a name of your throw',
+        input_message_content=types.InputTextMessageContent(
+            views.inline_help(), parse_mode='HTML'
+        )
+    )
+
+
+def inline_roll(query: object, formula: str, throw_name: str = ''):
+    """
+    Inline result with a rolled formula, None if there is nothing to roll
+    """
+    try:
+        roller = roller_for(formula, query.from_user)
+    except FormulaError:
+        return None
+    hand = roller.hand
+    if not (hand.dices or hand.attrs or hand.modifiers):
+        return None
+    return types.InlineQueryResultArticle(
+        id=f'{throw_name or "roll"}-{hash(formula) & 0xffffffff}',
+        title=throw_name or f'Roll {formula}',
+        description=f'{formula} = {hand.result}',
+        input_message_content=types.InputTextMessageContent(
+            views.roll(roller, hand), parse_mode='HTML'
+        )
+    )
+
+
 def shorthand(message: object, dice: int):
     """
     Make a throw with one dice of cpecified type and
@@ -416,7 +963,7 @@ def shorthand(message: object, dice: int):
           as 20, 1d100 as 100, etc.)
     """
     descr = message.text[8:] if dice > 9 else message.text[7:]
-    roller = DiceRoller(f'/roll d{dice} ' + descr, message.from_user)
+    roller = roller_for(f'/roll d{dice} ' + descr, message.from_user)
     hand = roller.hand
-    Roll.register()
-    reply(message, views.roll(roller, hand))
+    register_roll(roller, hand)
+    reply_roll(message, roller, hand)
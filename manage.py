@@ -0,0 +1,98 @@
+"""
+Maintenance commands. Database is taken from DATABASE_URL.
+
+    python manage.py migrate-schema
+    python manage.py migrate-rolls
+    python manage.py prune-rolls --days 30
+    python manage.py build-tables
+"""
+
+import argparse
+import logging
+
+import odds
+import models
+from common.database import bind_database
+
+
+logging.basicConfig(level=logging.INFO)
+managelogger = logging.getLogger('managelogger')
+
+
+def migrate_schema(args):
+    """
+    Add new columns to existing tables, run before deploying new code
+    """
+    bind_database(models.db, mapping=False)
+    added = models.migrate_schema()
+    managelogger.info('Added columns: %s', ', '.join(added) or 'none')
+
+
+def migrate_rolls(args):
+    """
+    Move counts of raw Roll rows into hourly RollCounter rows
+    """
+    migrated = models.RollCounter.migrate_from_rolls(
+        batch=args.batch, up_to=args.up_to)
+    managelogger.info('Migrated %s rolls into hourly counters', migrated)
+
+
+def prune_rolls(args):
+    """
+    Delete raw Roll events older than the retention period
+    """
+    try:
+        deleted = models.Roll.prune(days=args.days, batch=args.batch)
+    except ValueError as exc:
+        managelogger.error('%s', exc)
+        raise SystemExit(1)
+    managelogger.info('Deleted %s raw roll events', deleted)
+
+
+def build_tables(args):
+    """
+    Precompute dice sum tables for /odds
+    """
+    path = args.path or odds.tables.path
+    size = odds.build_tables(path)
+    managelogger.info('Wrote %s bytes of dice tables to %s', size, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    schema = commands.add_parser(
+        'migrate-schema', help=migrate_schema.__doc__.strip())
+    schema.set_defaults(func=migrate_schema, database=False)
+
+    migrate = commands.add_parser(
+        'migrate-rolls', help=migrate_rolls.__doc__.strip())
+    migrate.add_argument('--batch', type=int, default=5000)
+    migrate.add_argument(
+        '--up-to', type=int, default=None,
+        help='migrate rolls up to this id, defaults to the last one '
+             'written before rolls were counted live')
+    migrate.set_defaults(func=migrate_rolls)
+
+    prune = commands.add_parser(
+        'prune-rolls', help=prune_rolls.__doc__.strip())
+    prune.add_argument('--days', type=int, default=None,
+                       help='defaults to ROLL_EVENTS_RETENTION')
+    prune.add_argument('--batch', type=int, default=5000)
+    prune.set_defaults(func=prune_rolls)
+
+    tables = commands.add_parser(
+        'build-tables', help=build_tables.__doc__.strip())
+    tables.add_argument('--path', default=None,
+                        help='defaults to DICE_TABLES_FILE')
+    tables.set_defaults(func=build_tables, database=False)
+
+    args = parser.parse_args()
+    if getattr(args, 'database', True):
+        bind_database(models.db)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,25 @@
-from dataclasses import dataclass
+import os
+import csv
+import io
+import json
+import sys
+from array import array
+from collections import Counter
+from dataclasses import astuple, dataclass, field
 from datetime import datetime, timedelta
-from typing import Tuple
+from typing import Dict, Iterator, List, Tuple
 
 from pony.orm import Database
 from pony.orm import PrimaryKey, Required, Optional, Set
 from pony.orm import db_session
-from pony.orm import select
+from pony.orm import select, desc
 from pony.orm.core import ObjectNotFound, TransactionIntegrityError
+from pony.orm.dbapiprovider import DatabaseError
 
 from common.helpers import modifier_dictionary, check_formula
+from common.background import writer
+from common.database import read_only_session
+from common.metrics import counters
 
 
 db = Database()
@@ -61,19 +72,55 @@ class User(db.Entity):
             raise AssertionError(
                 'You cannot have more than 5 characters per account. '
             )
-        if name[0].isdigit():
-            raise ValueError(
-                'Your char name must not start with a digit.'
-            )
-        if len(name) > 20:
-            raise ValueError(
-                'Your char name is too long. Max length for names: 20.'
-            )
+        Char.check_name(name)
 
         newchar = Char(owner=self, name=name, active=False)
         self.set_active_char(newchar.name)
         return newchar
 
+    @db_session
+    def import_char(self, sheet) -> Tuple[object, bool]:
+        """
+        Write a validated CharSheet in one transaction: a new char, or
+        new attributes and throws of the char with the same name.
+        Collisions with existing ones are checked against sets loaded
+        with one query each. Returns the char and whether it is new.
+        """
+        char = self.chars.filter(lambda x: x.name == sheet.name).get()
+        created = char is None
+        if created:
+            if len(self.chars) > 5:
+                raise AssertionError(
+                    'You cannot have more than 5 characters per account. '
+                )
+            char = Char(owner=self, name=sheet.name, active=False)
+            names, aliases, throws = set(), set(), set()
+        else:
+            names, aliases = set(), set()
+            for name, alias in select(
+                    (a.name, a.alias) for a in Attribute if a.char == char):
+                names.add(name)
+                aliases.add(alias)
+            throws = set(select(t.name for t in Throw if t.char == char))
+        collisions = (
+            [a.name for a in sheet.attributes if a.name in names]
+            + [f'${a.alias}' for a in sheet.attributes if a.alias in aliases]
+            + [name for name, _ in sheet.throws if name in throws]
+        )
+        if collisions:
+            raise NameError(
+                f'Char {char.name} has already: {", ".join(collisions)}. '
+                'Nothing was imported.'
+            )
+        for attr in sheet.attributes:
+            Attribute(char=char, name=attr.name, alias=attr.alias,
+                      value=attr.value, modifier=attr.modifier)
+        for name, formula in sheet.throws:
+            Throw(char=char, name=name, formula=formula)
+        if created:
+            self.set_active_char(char.name)
+        return char, created
+
     @db_session
     def delete_char(self, name: str) -> bool:
         char = self.chars.filter(lambda x: x.name == name).get()
@@ -114,9 +161,36 @@ class Char(db.Entity):
     name = Required(str)
     throws = Set('Throw')
     attributes = Set('Attribute')
+    records = Set('RollRecord')
+    parties = Set('Party')
     active = Required(bool, default=False)
+    history = Required(bool, default=False)
     registered = Required(datetime, default=datetime.now)
 
+    @staticmethod
+    @read_only_session()
+    def active_throw(user_id: int, name: str) -> Tuple[str, str]:
+        """
+        Look up a throw formula of user's active char. Returns the char
+        name (None if there is no active char) and the formula ('' if not
+        found). Served by the read replica if there is one.
+        """
+        char = Char.get(lambda x: x.owner.user_id == user_id and x.active)
+        if not char:
+            return None, ''
+        return char.name, char.throw(name)
+
+    @staticmethod
+    @read_only_session()
+    def active_throws(user_id: int) -> List[Tuple[str, str]]:
+        """
+        (name, formula) pairs of all throws of user's active char
+        """
+        return select(
+            (t.name, t.formula) for t in Throw
+            if t.char.owner.user_id == user_id and t.char.active
+        ).order_by(1)[:]
+
     @db_session
     def throw(self, name: str) -> str:
         requested_throw = self.throws.filter(lambda x: x.name == name).get()
@@ -125,6 +199,17 @@ class Char(db.Entity):
         else:
             return ''
 
+    @staticmethod
+    def check_name(name: str):
+        if name[0].isdigit():
+            raise ValueError(
+                'Your char name must not start with a digit.'
+            )
+        if len(name) > 20:
+            raise ValueError(
+                'Your char name is too long. Max length for names: 20.'
+            )
+
     @db_session
     def create_throw(self, throw_name: str, formula: str) -> str:
         exists = self.throw(throw_name)
@@ -154,35 +239,11 @@ class Char(db.Entity):
     def create_attribute(self, name: str, alias: str, value: str,
                          modifier: str or None = None):
         """
-        Create an attribute. Note func takes only strings as arguments
+        Create an attribute and return it. Note func takes only strings
+        as arguments
         """
-        common_error_message = (
-                'Incorrect command. Please check the examples: '
-                '/addmod Dexterity DEX 20\n'
-                '/addmod Dexterity DEX 20 5\n'
-            )
-        if not all((name, alias, value)):
-            raise ValueError(common_error_message)
-
-        if alias[0].isdigit():
-            raise ValueError('Alias must not start with a digit!')
-
-        if name[0].isdigit():
-            raise ValueError('Attribute name must not start with a digit!')
-
-        if any((len(name) > 25, len(alias) > 8)):
-            raise ValueError(
-                'Attribute name or alias are too long.\n'
-                'Max length for attribute name: 25, '
-                'Max length for alias: 8'
-            )
-
-        if any((len(name) < 4, len(alias) < 2)):
-            raise ValueError(
-                'Attribute name or alias are too short.\n'
-                'Min length for attribute name: 4, '
-                'Min length for alias: 2'
-            )
+        name, alias, value, modifier = Attribute.check(
+            name, alias, value, modifier)
 
         # existence check
         _, name_exists1 = self.get_attribute_by_alias(alias)
@@ -193,21 +254,10 @@ class Char(db.Entity):
                 f'named {name} or attribute alias {alias}. '
                 'Please check /chars or ask for /help'
             )
-
-        # values check
-        try:
-            value = int(value)
-            if modifier:
-                modifier = int(modifier)
-            else:
-                modifier = Attribute.get_modifier(value)
-        except ValueError:
-            raise ValueError(common_error_message)
-        else:
-            Attribute(
-                char=self, name=name, alias=alias.upper(), value=value,
-                modifier=modifier
-            )
+        return Attribute(
+            char=self, name=name, alias=alias, value=value,
+            modifier=modifier
+        )
 
     @db_session
     def delete_attribute(self, name: str):
@@ -230,6 +280,11 @@ class Char(db.Entity):
         else:
             return None, None
 
+    @staticmethod
+    @db_session
+    def switch_history(char_id: int, enabled: bool):
+        Char[char_id].history = enabled
+
     @db_session
     def get_attribute_by_name(self, name: str) -> int:
         by_name = self.attributes.filter(
@@ -237,6 +292,45 @@ class Char(db.Entity):
         if by_name:
             return by_name.modifier
 
+    def snapshot(self):
+        """
+        Plain copy of the char with its attributes and throws, usable
+        without database. Collections should be loaded (or prefetched).
+        """
+        return CharSnapshot(
+            id=self.id, name=self.name, owner_id=self.owner.user_id,
+            history=self.history,
+            aliases={
+                attr.alias: (attr.modifier, attr.name)
+                for attr in self.attributes if attr.alias
+            },
+            modifiers={attr.name: attr.modifier for attr in self.attributes},
+            throws={throw.name: throw.formula for throw in self.throws},
+        )
+
+
+@dataclass(frozen=True)
+class CharSnapshot:
+    """
+    Char data needed for rolls, with the same lookup methods as Char
+    """
+    id: int
+    name: str
+    owner_id: int
+    history: bool = False
+    aliases: Dict[str, Tuple[int, str]] = field(default_factory=dict)
+    modifiers: Dict[str, int] = field(default_factory=dict)
+    throws: Dict[str, str] = field(default_factory=dict)
+
+    def get_attribute_by_alias(self, alias: str) -> Tuple[int, str]:
+        return self.aliases.get(alias, (None, None))
+
+    def get_attribute_by_name(self, name: str) -> int:
+        return self.modifiers.get(name)
+
+    def throw(self, name: str) -> str:
+        return self.throws.get(name, '')
+
 
 class Throw(db.Entity):
     char = Required(Char)
@@ -251,6 +345,52 @@ class Attribute(db.Entity):
     value = Required(int)
     modifier = Optional(int)
 
+    @staticmethod
+    def check(name: str, alias: str, value: str,
+              modifier: str or None = None) -> tuple:
+        """
+        Validate attribute fields given as strings. Returns them ready
+        to be stored: (name, ALIAS, value, modifier)
+        """
+        common_error_message = (
+                'Incorrect command. Please check the examples: '
+                '/addmod Dexterity DEX 20\n'
+                '/addmod Dexterity DEX 20 5\n'
+            )
+        if not all((name, alias, value)):
+            raise ValueError(common_error_message)
+
+        if alias[0].isdigit():
+            raise ValueError('Alias must not start with a digit!')
+
+        if name[0].isdigit():
+            raise ValueError('Attribute name must not start with a digit!')
+
+        if any((len(name) > 25, len(alias) > 8)):
+            raise ValueError(
+                'Attribute name or alias are too long.\n'
+                'Max length for attribute name: 25, '
+                'Max length for alias: 8'
+            )
+
+        if any((len(name) < 4, len(alias) < 2)):
+            raise ValueError(
+                'Attribute name or alias are too short.\n'
+                'Min length for attribute name: 4, '
+                'Min length for alias: 2'
+            )
+
+        # values check
+        try:
+            value = int(value)
+            if modifier:
+                modifier = int(modifier)
+            else:
+                modifier = Attribute.get_modifier(value)
+        except ValueError:
+            raise ValueError(common_error_message)
+        return name, alias.upper(), value, modifier
+
     @staticmethod
     def get_modifier(value: int) -> int:
         """
@@ -259,16 +399,325 @@ class Attribute(db.Entity):
         return modifier_dictionary.get(value, 0)
 
 
-class Roll(db.Entity):
+class Party(db.Entity):
+    """
+    Chars of several users gathered in a group chat for party rolls
+    """
+    chat_id = PrimaryKey(int, size=64, auto=False)
+    chars = Set(Char)
+
+    # one party roll is one message, keep it readable
+    MAX_SIZE = 30
+
+    @staticmethod
+    @db_session
+    def join(chat_id: int, char: Char):
+        party = Party.get(chat_id=chat_id) or Party(chat_id=chat_id)
+        char = Char[char.id]
+        if char in party.chars:
+            raise NameError(f'{char.name} is in the party already.')
+        if party.chars.count() >= Party.MAX_SIZE:
+            raise AssertionError(
+                f'A party cannot have more than {Party.MAX_SIZE} chars.')
+        party.chars.add(char)
+
+    @staticmethod
+    @db_session
+    def leave(chat_id: int, user_id: int) -> List[str]:
+        """
+        Remove all chars of the user from the party, return their names
+        """
+        party = Party.get(chat_id=chat_id)
+        if not party:
+            return []
+        chars = party.chars.filter(lambda x: x.owner.user_id == user_id)[:]
+        party.chars.remove(chars)
+        return [char.name for char in chars]
+
+    @staticmethod
+    @read_only_session()
+    def members(chat_id: int) -> List[CharSnapshot]:
+        """
+        Snapshots of all party chars. Chars, their owners, attributes and
+        throws are loaded with a fixed number of queries, whatever
+        the size of the party is.
+        """
+        chars = select(
+            c for c in Char for p in c.parties if p.chat_id == chat_id
+        ).prefetch(Char.owner, Char.attributes, Char.throws)[:]
+        return [char.snapshot() for char in chars]
+
+
+def pack(typecode: str, values: List[int]) -> bytes:
+    """
+    Pack integers into little-endian bytes of array(typecode)
+    """
+    packed = array(typecode, values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack(typecode: str, data: bytes) -> List[int]:
+    unpacked = array(typecode)
+    unpacked.frombytes(data)
+    if sys.byteorder == 'big':
+        unpacked.byteswap()
+    return unpacked.tolist()
+
+
+class RollRecord(db.Entity):
+    """
+    A roll in the history of a char (only for chars with history on).
+    Dice groups are stored as packed (number, value) pairs, faces of all
+    the groups as one packed array, attribute and plain modifiers as
+    another one. Dices and faces are 16-bit (formulas allow up to 999
+    dices of up to 999 faces), modifiers 32-bit like the int columns
+    of attributes.
+    """
+    char = Required(Char, index=True)
     date = Required(datetime, default=datetime.now)
+    formula = Required(str)
+    dices = Required(bytes)
+    faces = Required(bytes)
+    modifiers = Required(bytes)
+    total = Required(int)
+
+    EXPORT_FIELDS = ('date', 'formula', 'dices', 'modifiers', 'total')
+    HISTORY_LIMIT = 10
 
     @classmethod
-    @db_session
-    def register(cls):
-        return cls()
+    def store(cls, char_id: int, formula: str, dices: bytes, faces: bytes,
+              modifiers: bytes, total: int, date: datetime):
+        """
+        Should be called inside db_session (see common.background.writer)
+        """
+        cls(char=Char[char_id], formula=formula, dices=dices, faces=faces,
+            modifiers=modifiers, total=total, date=date)
+
+    @staticmethod
+    def packed(hand) -> dict:
+        """
+        Pack a rolled Hand into RollRecord.store() keyword arguments
+        """
+        dices, faces = [], []
+        for dice_group in hand.dices:
+            dices.extend((dice_group.number, dice_group.value))
+            faces.extend(dice_group.results)
+        modifiers = [attr[0] for attr in hand.attrs if attr[0]]
+        modifiers.extend(hand.modifiers)
+        return dict(
+            dices=pack('H', dices), faces=pack('H', faces),
+            modifiers=pack('i', modifiers), total=hand.result,
+            date=datetime.now()
+        )
+
+    def as_dict(self) -> dict:
+        faces = iter(unpack('H', self.faces))
+        pairs = unpack('H', self.dices)
+        dices = []
+        for number, value in zip(pairs[::2], pairs[1::2]):
+            results = [next(faces) for _ in range(number)]
+            dices.append(f'{number}d{value}:' + ','.join(map(str, results)))
+        return {
+            'date': self.date.isoformat(sep=' ', timespec='seconds'),
+            'formula': self.formula,
+            'dices': ' '.join(dices),
+            'modifiers': unpack('i', self.modifiers),
+            'total': self.total,
+        }
 
     @staticmethod
+    @read_only_session()
+    def latest(char_id: int, limit: int = HISTORY_LIMIT) -> List[dict]:
+        records = select(
+            r for r in RollRecord if r.char.id == char_id
+        ).order_by(lambda r: desc(r.id))[:limit]
+        return [record.as_dict() for record in records]
+
+    @staticmethod
+    def iter_export(char_id: int, fmt: str = 'csv',
+                    page: int = 500) -> Iterator[str]:
+        """
+        Yield history of a char as CSV or JSON text chunks. Records are
+        read page by page, each page in its own short session, so the
+        whole history is never loaded at once.
+        """
+        if fmt == 'json':
+            yield '['
+        else:
+            buffer = io.StringIO()
+            csv_writer = csv.DictWriter(buffer, RollRecord.EXPORT_FIELDS)
+            csv_writer.writeheader()
+        first = True
+        last_id = 0
+        while True:
+            with read_only_session():
+                records = select(
+                    r for r in RollRecord
+                    if r.char.id == char_id and r.id > last_id
+                ).order_by(RollRecord.id)[:page]
+                rows = [record.as_dict() for record in records]
+                if records:
+                    last_id = records[-1].id
+            if not rows:
+                break
+            if fmt == 'json':
+                yield ''.join(
+                    ('' if first and i == 0 else ',') + json.dumps(row)
+                    for i, row in enumerate(rows)
+                )
+                first = False
+            else:
+                for row in rows:
+                    row['modifiers'] = ' '.join(map(str, row['modifiers']))
+                    csv_writer.writerow(row)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        if fmt == 'json':
+            yield ']'
+        else:
+            yield buffer.getvalue()
+
+
+# raw Roll events are kept only if retention is set (days)
+ROLL_EVENTS_RETENTION = int(os.environ.get('ROLL_EVENTS_RETENTION', 0))
+ROLL_COUNTER_SHARDS = int(os.environ.get('ROLL_COUNTER_SHARDS', 8))
+MIGRATED_SHARD = -1
+# pid of the process which marked RollSwitch already, see Roll.register()
+_switch_marked = None
+
+
+def current_hour(moment: datetime = None) -> datetime:
+    return (moment or datetime.now()).replace(
+        minute=0, second=0, microsecond=0)
+
+
+class RollCounter(db.Entity):
+    """
+    Number of rolls made within an hour, split into shards (by worker
+    process) so that concurrent workers do not update the same row.
+    """
+    hour = Required(datetime)
+    shard = Required(int)
+    count = Required(int, default=0)
+    PrimaryKey(hour, shard)
+
+    @classmethod
     @db_session
+    def increment(cls, number: int = 1, moment: datetime = None,
+                  shard: int = None):
+        """
+        Add number of rolls to the counter of the hour with a single upsert
+        """
+        hour = current_hour(moment)  # noqa F841, used in SQL below
+        if shard is None:
+            shard = os.getpid() % ROLL_COUNTER_SHARDS
+        db.execute(
+            f'INSERT INTO {cls._table_} (hour, shard, count) '
+            'VALUES ($hour, $shard, $number) '
+            'ON CONFLICT (hour, shard) '
+            f'DO UPDATE SET count = {cls._table_}.count + excluded.count'
+        )
+
+    @staticmethod
+    @read_only_session()
+    def total(since: datetime = None) -> int:
+        if since is None:
+            return select(c.count for c in RollCounter).sum()
+        return select(
+            c.count for c in RollCounter if c.hour >= current_hour(since)
+        ).sum()
+
+    @classmethod
+    def migrate_from_rolls(cls, batch: int = 5000,
+                           up_to: int = None) -> int:
+        """
+        One-time migration of raw Roll rows into hourly counters. Only
+        rows up to the id `up_to` are migrated: by default the last one
+        written before rolls were counted live (see RollSwitch), as
+        later rows (written while ROLL_EVENTS_RETENTION is on) are
+        counted already. Counts go to a dedicated shard and replace its
+        previous values, so the migration is safe to repeat as long as
+        Roll rows are not pruned.
+        """
+        if up_to is None:
+            up_to = RollSwitch.last_roll_before()
+        hours = Counter()
+        last_id = 0
+        while True:
+            with db_session:
+                chunk = select(
+                    (r.id, r.date) for r in Roll
+                    if r.id > last_id and r.id <= up_to
+                ).order_by(1)[:batch]
+            if not chunk:
+                break
+            for roll_id, date in chunk:
+                hours[current_hour(date)] += 1
+            last_id = chunk[-1][0]
+        with db_session:
+            select(
+                c for c in RollCounter if c.shard == MIGRATED_SHARD
+            ).delete(bulk=True)
+            for hour, number in hours.items():
+                RollCounter(hour=hour, shard=MIGRATED_SHARD, count=number)
+        return sum(hours.values())
+
+
+class Roll(db.Entity):
+    """
+    Raw roll event log. Written only if ROLL_EVENTS_RETENTION is set,
+    statistics are computed from RollCounter.
+    """
+    date = Required(datetime, default=datetime.now)
+
+    @classmethod
+    def register(cls, number: int = 1):
+        """
+        Count rolls in shared memory; counters are flushed
+        to RollCounter in background, raw events are written
+        (or spooled while the database is down) by the writer
+        """
+        global _switch_marked
+        counters.count_rolls(number)
+        if ROLL_EVENTS_RETENTION:
+            if _switch_marked != os.getpid():
+                # before the first raw event of the process
+                writer.submit(RollSwitch.mark)
+                _switch_marked = os.getpid()
+            writer.submit(cls.log_events, number, datetime.now())
+
+    @classmethod
+    def log_events(cls, number: int, date: datetime):
+        for _ in range(number):
+            cls(date=date)
+
+    @staticmethod
+    def prune(days: int = None, batch: int = 5000) -> int:
+        """
+        Delete raw Roll events older than retention period (in batches).
+        Refuses to run without a retention period: it would delete all
+        the events, including ones not migrated into counters yet.
+        """
+        days = ROLL_EVENTS_RETENTION if days is None else days
+        if days < 1:
+            raise ValueError(
+                'Retention period is not set: pass --days or set '
+                'ROLL_EVENTS_RETENTION')
+        border = datetime.now() - timedelta(days=days)
+        deleted = 0
+        while True:
+            with db_session:
+                ids = select(r.id for r in Roll if r.date < border)[:batch]
+                if not ids:
+                    return deleted
+                Roll.select(lambda r: r.id in ids).delete(bulk=True)
+            deleted += len(ids)
+
+    @staticmethod
+    @read_only_session()
     def get_stats():
         users_total = select(u for u in User).count()
         chars_total = select(ch for ch in Char).count()
@@ -282,25 +731,76 @@ class Roll(db.Entity):
         ).count()
         throws_total = select(thr for thr in Throw).count()
         attributes_total = select(attr for attr in Attribute).count()
-        rolls_total = select(roll for roll in Roll).count()
-        rolls_month = select(
-            roll for roll in Roll
-            if roll.date.month == datetime.now().date().month
-        ).count()
-        rolls_week = select(
-            roll for roll in Roll
-            if roll.date >= datetime.now() - timedelta(days=7)
-        ).count()
-        rolls_today = select(
-            roll for roll in Roll
-            if roll.date == datetime.now().date()
-        ).count()
+        today = datetime.now().replace(
+            hour=0, minute=0, second=0, microsecond=0)
+        rolls_total = RollCounter.total()
+        rolls_month = RollCounter.total(since=today.replace(day=1))
+        rolls_week = RollCounter.total(
+            since=datetime.now() - timedelta(days=7))
+        rolls_today = RollCounter.total(since=today)
         return Statistics(
             users_total, chars_total, new_users_week, new_chars_week,
             throws_total, attributes_total, rolls_total, rolls_month,
             rolls_week, rolls_today)
 
 
+class RollSwitch(db.Entity):
+    """
+    The last raw Roll row written before rolls were counted live.
+    Rows after it are counted already, RollCounter.migrate_from_rolls()
+    leaves them out.
+    """
+    last_roll = Required(int)
+
+    @classmethod
+    def mark(cls):
+        """
+        Remember the last Roll row, once for all processes. Run by the
+        writer before the first raw event of a process, within its
+        db_session
+        """
+        db.execute(
+            f'INSERT INTO {cls._table_} (id, last_roll) '
+            f'SELECT 1, COALESCE(MAX(id), 0) FROM {Roll._table_} '
+            # WHERE: SQLite takes ON CONFLICT for a join constraint else
+            'WHERE true ON CONFLICT (id) DO NOTHING'
+        )
+
+    @staticmethod
+    @db_session
+    def last_roll_before() -> int:
+        """
+        Id of the last Roll row before the switch, or of the last one
+        at all if rolls were not counted live with raw events yet
+        """
+        switch = RollSwitch.get(id=1)
+        if switch is not None:
+            return switch.last_roll
+        return select(r.id for r in Roll).max() or 0
+
+
+def cached_stats() -> 'Statistics':
+    """
+    Statistics from the shared snapshot, without the database (unless
+    there is no snapshot yet). Rolls counted after the snapshot was
+    taken are added to roll totals.
+    """
+    values, mark, _ = counters.snapshot()
+    if values is None:
+        counters.refresh_snapshot()
+        values, mark, _ = counters.snapshot()
+    if values is None:
+        # another process is taking the very first snapshot
+        return Roll.get_stats()
+    stats = Statistics(*values)
+    fresh = counters.totals()['rolls'] - mark
+    stats.rolls_total += fresh
+    stats.rolls_month += fresh
+    stats.rolls_week += fresh
+    stats.rolls_today += fresh
+    return stats
+
+
 @dataclass
 class Statistics:
     users_total: int = 0
@@ -315,6 +815,56 @@ class Statistics:
     rolls_today: int = 0
 
 
+counters.on_flush(
+    flush=RollCounter.increment,
+    refresh=lambda: astuple(Roll.get_stats())
+)
+
+
+# columns added to tables which older versions created already:
+# (table, column, SQL definition)
+SCHEMA_CHANGES = (
+    ('Char', 'history', 'BOOLEAN NOT NULL DEFAULT FALSE'),
+)
+
+
+def selects(sql: str) -> bool:
+    """
+    Whether the query runs, e.g. whether a table or a column exists
+    """
+    try:
+        with db_session:
+            db.execute(sql)
+        return True
+    except DatabaseError:
+        return False
+
+
+def migrate_schema() -> List[str]:
+    """
+    Add SCHEMA_CHANGES columns missing in existing tables: Pony creates
+    new tables, but never alters existing ones. Should be run before
+    the new code starts, with the database bound without mapping.
+    Returns added columns; safe to repeat.
+    """
+    added = []
+    for table, column, definition in SCHEMA_CHANGES:
+        # e.g. PostgreSQL tables of Pony are lowercase
+        table = db.provider.normalize_name(table)
+        column = db.provider.normalize_name(column)
+        if not selects(f'SELECT 1 FROM "{table}" WHERE 1 = 0'):
+            continue  # a new database, the table will be created
+        # qualified: SQLite takes an unknown "column" for a string
+        if selects(
+                f'SELECT "{table}"."{column}" FROM "{table}" WHERE 1 = 0'):
+            continue
+        with db_session:
+            db.execute(
+                f'ALTER TABLE "{table}" ADD COLUMN "{column}" {definition}')
+        added.append(f'{table}.{column}')
+    return added
+
+
 if __name__ == '__main__':
     with db_session:
         alex = User(user_id=138946204)
@@ -0,0 +1,300 @@
+"""
+Exact odds of dice formulas. Distributions are combined by
+convolution and keep/drop selections are computed with dynamic
+programming over die faces, so no outcome is enumerated one by one.
+
+Sums of common dices (up to TABLE_MAX_DICE of TABLE_SIDES) are read
+from precomputed tables, built with `python manage.py build-tables`
+into DICE_TABLES_FILE. Without the file they are computed on demand.
+"""
+
+import os
+import zlib
+from math import comb, sqrt
+from typing import List, Tuple
+
+from roller import DiceGroup, Hand, MAX_EXPLOSIONS
+from common.dicetables import DiceTables, write_tables
+
+
+# rough limit of elementary operations for a single formula
+MAX_WORK = 20_000_000
+
+TABLE_SIDES = (4, 6, 8, 10, 12, 20, 100)
+TABLE_MAX_DICE = 99
+TABLES_CHECKSUM = zlib.crc32(f'{TABLE_SIDES} {TABLE_MAX_DICE}'.encode())
+
+
+class OddsTooComplex(ValueError):
+    """
+    Raised when exact odds would take too long to compute
+    """
+
+
+def check_work(work: float):
+    if work > MAX_WORK:
+        raise OddsTooComplex(
+            'This formula is too complex to compute the exact odds.'
+        )
+
+
+class Distribution:
+    """
+    Probability distribution of an integer total:
+    probs[i] is the probability of total == offset + i
+    """
+
+    def __init__(self, offset: int, probs: List[float]):
+        self.offset = offset
+        self.probs = probs
+
+    @classmethod
+    def point(cls, value: int = 0):
+        return cls(value, [1.0])
+
+    @classmethod
+    def uniform(cls, sides: int):
+        return cls(1, [1 / sides] * sides)
+
+    def shift(self, value: int):
+        return Distribution(self.offset + value, self.probs)
+
+    def __add__(self, other):
+        """
+        Distribution of the sum of two independent totals
+        """
+        if len(self.probs) < len(other.probs):
+            return other + self
+        check_work(len(self.probs) * len(other.probs))
+        probs = [0.0] * (len(self.probs) + len(other.probs) - 1)
+        for j, q in enumerate(other.probs):
+            if q:
+                for i, p in enumerate(self.probs, j):
+                    probs[i] += p * q
+        return Distribution(self.offset + other.offset, probs)
+
+    def add_uniform(self, sides: int):
+        """
+        Add one fair die: a moving window sum instead of convolution
+        """
+        size = len(self.probs)
+        check_work(size + sides)
+        probs = [0.0] * (size + sides - 1)
+        window = 0.0
+        for i in range(size + sides - 1):
+            if i < size:
+                window += self.probs[i]
+            if i >= sides:
+                window -= self.probs[i - sides]
+            probs[i] = window / sides
+        return Distribution(self.offset + 1, probs)
+
+    def items(self) -> List[Tuple[int, float]]:
+        return [
+            (self.offset + i, p) for i, p in enumerate(self.probs) if p > 0
+        ]
+
+    @property
+    def min(self) -> int:
+        return self.items()[0][0]
+
+    @property
+    def max(self) -> int:
+        return self.items()[-1][0]
+
+    @property
+    def mean(self) -> float:
+        return sum(total * p for total, p in self.items())
+
+    @property
+    def stdev(self) -> float:
+        mean = self.mean
+        return sqrt(sum((total - mean) ** 2 * p for total, p in self.items()))
+
+    @property
+    def mode(self) -> int:
+        return max(self.items(), key=lambda item: item[1])[0]
+
+    def at_least(self, total: int) -> float:
+        return sum(self.probs[max(total - self.offset, 0):])
+
+
+def die(sides: int, explode: bool = False) -> Distribution:
+    """
+    Distribution of a single die. An exploding die rolls again on its
+    max face (up to MAX_EXPLOSIONS times) and sums the faces.
+    """
+    if not explode or sides < 2:
+        return Distribution.uniform(sides)
+    probs = [0.0] * (sides * (MAX_EXPLOSIONS + 1))
+    chance = 1.0
+    for depth in range(MAX_EXPLOSIONS + 1):
+        chance /= sides
+        last = depth == MAX_EXPLOSIONS
+        for face in range(1, sides + (1 if last else 0)):
+            probs[depth * sides + face - 1] += chance
+    return Distribution(1, probs)
+
+
+def keep_distribution(single: Distribution, number: int, keep: int,
+                      highest: bool = True) -> Distribution:
+    """
+    Distribution of the sum of `keep` highest (or lowest) of `number`
+    independent dices with the `single` distribution.
+
+    Faces are visited from the best one down (from the worst one up for
+    the lowest). A state is the number of dices assigned so far and the
+    sum of the kept ones; as soon as `keep` dices are assigned the kept
+    sum is final and the rest of dices just have to show worse faces.
+    """
+    if keep <= 0:
+        return Distribution.point(0)
+    faces = single.items()
+    if highest:
+        faces.reverse()
+    top = max(abs(face) for face, _ in faces)
+    check_work(len(faces) * keep * keep * top * number)
+
+    result = {}
+    states = {0: {0: 1.0}}       # assigned dices -> kept sum -> weight
+    rest = 1.0                   # mass of faces not visited yet
+    for face, p in faces:
+        rest = max(rest - p, 0.0)
+        new_states = {}
+        for assigned, sums in states.items():
+            left = number - assigned
+            to_keep = keep - assigned
+            for count in range(left + 1):
+                weight = comb(left, count) * p ** count
+                if not weight:
+                    continue
+                if count < to_keep:
+                    target = new_states.setdefault(assigned + count, {})
+                    for total, w in sums.items():
+                        total += count * face
+                        target[total] = target.get(total, 0.0) + w * weight
+                else:
+                    weight *= rest ** (left - count)
+                    if not weight:
+                        continue
+                    for total, w in sums.items():
+                        total += to_keep * face
+                        result[total] = result.get(total, 0.0) + w * weight
+        states = new_states
+
+    low, high = min(result), max(result)
+    probs = [0.0] * (high - low + 1)
+    for total, p in result.items():
+        probs[total - low] = p
+    return Distribution(low, probs)
+
+
+def dice_sum(sides: int, number: int) -> Distribution:
+    """
+    Distribution of the sum of `number` fair dices, from the tables
+    when they have it
+    """
+    if number <= 0:
+        return Distribution.point(0)
+    table = tables.get(sides, number)
+    if table is not None:
+        return Distribution(*table)
+    dist = Distribution.point(0)
+    for _ in range(number):
+        dist = dist.add_uniform(sides)
+    return dist
+
+
+def is_plain(group: DiceGroup) -> bool:
+    """
+    Group is just a sum of fair dices
+    """
+    return group.keep >= group.number and not group.explode
+
+
+def group_distribution(group: DiceGroup) -> Distribution:
+    """
+    Distribution of DiceGroup summary
+    """
+    if group.keep < group.number:
+        return keep_distribution(
+            die(group.value, group.explode), group.number, group.keep,
+            group.highest
+        )
+    if not group.explode:
+        return dice_sum(group.value, group.number)
+    dist = Distribution.point(0)
+    single = die(group.value, explode=True)
+    for _ in range(group.number):
+        dist = dist + single
+    return dist
+
+
+def hand_spec(hand: Hand) -> tuple:
+    """
+    Normalized hand, a key for cached odds: sorted dice groups
+    (number, sides, explode, keep, highest) with plain groups of the
+    same dice summed up (2d6 + 3d6 is 5d6), and the constant part
+    """
+    plain, groups = {}, []
+    for group in hand.dices:
+        if is_plain(group):
+            plain[group.value] = plain.get(group.value, 0) + group.number
+        else:
+            groups.append((group.number, group.value, group.explode,
+                           group.keep, group.highest))
+    groups.extend(
+        (number, sides, False, number, True)
+        for sides, number in plain.items())
+    constant = sum(attr[0] for attr in hand.attrs if attr[0])
+    constant += sum(hand.modifiers)
+    return tuple(sorted(groups)), constant
+
+
+def spec_distribution(spec: tuple) -> Distribution:
+    """
+    Distribution of a normalized hand, see hand_spec()
+    """
+    groups, constant = spec
+    dist = Distribution.point(0)
+    for number, sides, explode, keep, highest in groups:
+        dist = dist + group_distribution(
+            DiceGroup(number, sides, explode, keep, highest))
+    return dist.shift(constant)
+
+
+def hand_distribution(hand: Hand) -> Distribution:
+    """
+    Distribution of Hand result: all dice groups plus modifiers
+    """
+    return spec_distribution(hand_spec(hand))
+
+
+def chances(dist: Distribution, rows: int = 10) -> List[Tuple[int, float]]:
+    """
+    Chances to get at least some totals, evenly spread from min to max
+    """
+    low, high = dist.min, dist.max
+    step = max(-(-(high - low) // (rows - 1)), 1)
+    totals = sorted(set(range(low, high + 1, step)) | {high})
+    return [(total, dist.at_least(total)) for total in totals]
+
+
+def build_tables(path: str) -> int:
+    """
+    Write sums of 1 to TABLE_MAX_DICE dices of every TABLE_SIDES into a
+    tables file, return its size
+    """
+    def sums():
+        for sides in TABLE_SIDES:
+            dist = Distribution.point(0)
+            for number in range(1, TABLE_MAX_DICE + 1):
+                dist = dist.add_uniform(sides)
+                yield (sides, number), dist.offset, dist.probs
+    return write_tables(path, sums(), TABLES_CHECKSUM)
+
+
+tables = DiceTables(
+    os.environ.get('DICE_TABLES_FILE') or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'dice_tables.bin'),
+    TABLES_CHECKSUM)
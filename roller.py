@@ -1,61 +1,207 @@
 import re
-import random
+import html
+import heapq
+from collections import Counter
+from functools import lru_cache
 from typing import List, Tuple
 
 from models import User, Char
+from common.rng import get_stream
 from common.unicode import emoji
 
 
+# max number of extra rolls of a single exploding die
+MAX_EXPLOSIONS = 10
+
+DICE_PATTERN = re.compile(
+    r'(\d{0,3})[dDдД](\d{1,3})(!?)(?:(kh|kl|dh|dl|k|d)(\d{1,2}))?')
+# a dice group the pattern would miss or cut, like 1000d6
+TOO_MANY_DICES = re.compile(r'\d{4,}[dDдД]\d')
+
+
+class FormulaError(ValueError):
+    """
+    Formula which cannot be rolled as the user typed it
+    """
+
+
 class DiceGroup:
+    """
+    A group of same dices, like 4d6. Optionally exploding (d6!: every
+    max face is rolled once more and added to the die, up to
+    MAX_EXPLOSIONS times) and with keep/drop selection: 4d6kh3 keeps
+    the highest three dices, 2d20kl1 keeps the lowest, 4d6dl1 drops
+    the lowest one, 4d6dh1 drops the highest one.
 
-    def __init__(self, number: int = 1, value: int = 1):
+    Totals and max faces are computed once in roll(), templates only
+    read them. The verbose string is built on first access only, since
+    huge groups are rendered compactly instead.
+    """
+
+    __slots__ = (
+        'number', 'value', 'explode', 'keep', 'highest', 'selection',
+        'rolled', 'rolls', 'results', 'dropped', 'summary', 'crits',
+        '_verbose',
+    )
+
+    def __init__(self, number: int = 1, value: int = 1, explode: bool = False,
+                 keep: int = None, highest: bool = True, selection: str = ''):
         self.number: int = number
         self.value: int = value
-        self._results: List[int] = []
+        self.explode: bool = explode and value > 1
+        self.keep: int = number if keep is None else min(keep, number)
+        self.highest: bool = highest
+        self.selection: str = selection
+        self.rolled: bool = False
+        self.rolls: Tuple[Tuple[int, ...], ...] = ()  # faces of every die
+        self.results: Tuple[int, ...] = ()   # total of every die
+        self.dropped: frozenset = frozenset()  # indexes of dropped dices
+        self.summary: int = 0
+        self.crits: int = 0                  # dices with max first face
+        self._verbose: str = None
 
-    @property
-    def results(self):
-        if self._results:
-            return self._results
-        roll_results: List[int] = []
-        for i in range(self.number):
-            roll_results.append(random.randint(1, self.value))
-        self._results = roll_results
-        return self._results
+    @classmethod
+    def parse(cls, elem: str):
+        """
+        Make a DiceGroup from formula element like 2d20, d6!, 4d6kh3.
+        Returns None if elem is not a dice group.
+        """
+        spec = cls.spec(elem)
+        return cls(*spec) if spec else None
 
-    @property
-    def verbose(self):
-        return ' + '.join(
-            [
-                ''.join([emoji['lightning'], str(r)])
-                if r == self.value else str(r)
-                for r in self.results
-            ]
+    @staticmethod
+    def spec(elem: str) -> tuple:
+        """
+        DiceGroup arguments for formula element, None if it is not
+        a dice group
+        """
+        match = DICE_PATTERN.match(elem)
+        if not match and not TOO_MANY_DICES.match(elem):
+            return None
+        if not match or match.end() != len(elem):
+            # like 4d6kh100 or d1000: never roll a part of it
+            raise FormulaError(
+                f'Cannot roll {html.escape(elem)}: up to 999 dices of up '
+                'to 999 faces, keep or drop up to 99 of them (4d6kh3)')
+        if int(match.group(2)) < 1:
+            raise FormulaError(
+                f'Cannot roll {html.escape(elem)}: a dice has 1 face '
+                'at least')
+        number = int(match.group(1) or 1)
+        keep, highest = number, True
+        selector, count = match.group(4), match.group(5)
+        if selector:
+            count = int(count)
+            if selector in ('kh', 'k'):
+                keep, highest = min(count, number), True
+            elif selector == 'kl':
+                keep, highest = min(count, number), False
+            elif selector in ('dl', 'd'):
+                keep, highest = max(number - count, 0), True
+            elif selector == 'dh':
+                keep, highest = max(number - count, 0), False
+        return (
+            number, int(match.group(2)), bool(match.group(3)), keep, highest,
+            selector + str(count) if selector else ''
         )
 
+    def roll(self):
+        """
+        Roll the dices (once) and compute everything templates need
+        """
+        if self.rolled:
+            return self
+        rng = get_stream()
+        faces = rng.faces(self.value, self.number)
+        if self.explode:
+            rolls = []
+            for face in faces:
+                chain = [face]
+                while (chain[-1] == self.value
+                       and len(chain) <= MAX_EXPLOSIONS):
+                    chain.append(rng.randint(1, self.value))
+                rolls.append(tuple(chain))
+            self.rolls = tuple(rolls)
+            self.results = tuple(sum(chain) for chain in rolls)
+        else:
+            self.rolls = tuple((face,) for face in faces)
+            self.results = tuple(faces)
+        self.crits = faces.count(self.value)
+
+        if self.keep < self.number:
+            pick = heapq.nlargest if self.highest else heapq.nsmallest
+            kept = pick(self.keep, range(self.number),
+                        key=self.results.__getitem__)
+            self.dropped = frozenset(range(self.number)).difference(kept)
+            self.summary = sum(self.results[i] for i in kept)
+        else:
+            self.summary = sum(self.results)
+        self.rolled = True
+        return self
+
     @property
-    def summary(self):
-        return sum(self.results)
+    def verbose(self) -> str:
+        if self._verbose is None:
+            self._verbose = ' + '.join(
+                self._verbose_die(i, chain)
+                for i, chain in enumerate(self.rolls)
+            )
+        return self._verbose
+
+    def verbose_size(self) -> int:
+        """
+        Upper bound of len(verbose), without building it
+        """
+        digits = len(str(self.value)) + 1
+        faces = sum(len(chain) for chain in self.rolls)
+        return faces * digits + self.number * 4 + len(self.dropped) * 7
+
+    def histogram(self) -> List[Tuple[int, int]]:
+        """
+        (face, count) pairs of die totals, ordered by face
+        """
+        return sorted(Counter(self.results).items())
+
+    def _verbose_die(self, index: int, chain: Tuple[int, ...]) -> str:
+        faces = '!'.join(map(str, chain))
+        if chain[0] == self.value:
+            faces = emoji['lightning'] + faces
+        if index in self.dropped:
+            faces = f'<s>{faces}</s>'
+        return faces
 
     def __repr__(self):
-        return f'{self.number}d{self.value}'
+        return (
+            f'{self.number}d{self.value}'
+            f'{"!" if self.explode else ""}{self.selection}'
+        )
 
 
 class Hand:
+    """
+    Parsed formula: dice groups, attributes and modifiers. The result
+    is computed once in roll().
+    """
+
+    __slots__ = ('dices', 'attrs', 'modifiers', 'description', 'result')
+
     def __init__(self):
         self.dices: List[DiceGroup] = []
         self.attrs: List[Tuple[int, str]] = []
         self.modifiers: List[int] = []
         self.description: str = ''
+        self.result: int = None
 
-    @property
-    def result(self):
-        dices_result = sum([sum(dg.results) for dg in self.dices])
-        return (
-            dices_result +
-            sum([attr[0] for attr in self.attrs if attr[0]]) +
-            sum(self.modifiers)
-        )
+    def roll(self):
+        """
+        Roll all the dice groups and sum up the result
+        """
+        total = sum(attr[0] for attr in self.attrs if attr[0])
+        total += sum(self.modifiers)
+        for dice_group in self.dices:
+            total += dice_group.roll().summary
+        self.result = total
+        return self
 
     def __repr__(self):
         return (
@@ -69,10 +215,20 @@ class Hand:
 
 class DiceRoller:
 
-    def __init__(self, raw_formula: str, telegram_user_object: object):
+    def __init__(self, raw_formula: str, telegram_user_object: object,
+                 char: object = None, offline: bool = False):
+        """
+        `char` may be a preloaded Char or CharSnapshot to roll for,
+        instead of the active char of the telegram user. An offline
+        roller never touches the database: without a char attributes
+        are marked as unavailable.
+        """
         self.formula: str = raw_formula
         self.user_id: int = telegram_user_object.id
-        self.char: Char = self._get_char()
+        self.offline: bool = offline
+        self.char: Char = char
+        if char is None and not offline:
+            self.char = self._get_char()
         self.name: str = ''
         self._hand: Hand = None
 
@@ -83,12 +239,19 @@ class DiceRoller:
 
     @property
     def hand(self):
-        if self._hand:
-            return self._hand
-        else:
-            self._hand = self._get_hand()
+        """
+        Rolled hand
+        """
+        if self._hand is None:
+            self._hand = self.parse().roll()
         return self._hand
 
+    def parse(self) -> Hand:
+        """
+        Parsed, but not rolled hand
+        """
+        return self._get_hand()
+
     def _get_char(self) -> Char or None:
         botuser = User.get_user_by_id(self.user_id)
         char = botuser.active_char()
@@ -96,59 +259,80 @@ class DiceRoller:
 
     def _get_hand(self) -> Hand:
         hand = Hand()
-        sign = 1                             # sign in [1, -1]
-        sequence = self.formula.split()
-
-        for i, elem in enumerate(sequence):
-            # dices
-            dicegroup: re.Match = re.match(
-                r'(\d{0,3})[d, D, д, Д](\d{1,3})', elem)
-            if dicegroup:
-                number = dicegroup.group(1) or 1
-                hand.dices.append(
-                    DiceGroup(
-                        number=int(number),
-                        value=int(dicegroup.group(2))
-                    ))
-                continue
-
-            # modifiers
-            modifier: re.Match = re.match(r'\d{1,3}', elem)
-            if modifier:
-                hand.modifiers.append(int(modifier.group(0))*sign)
-                sign = 1
-                continue
-
-            # custom char attributes and attr aliases
-            alias: re.Match = re.match(r'\$([a-zA-ZА-Яа-я\-_]{2,7})', elem)
-            attr: re.Match = re.match(r'&([a-zA-ZА-Яа-я\-_]{2,25})', elem)
-            if any((alias, attr)) and self.char:
-                if alias:
-                    alias = alias.group(1)
-                    mod, name = self.char.get_attribute_by_alias(
-                        alias=alias
-                    )
-                    hand.attrs.append((mod, name) if name else (None, alias))
-                elif attr:
-                    name = attr.group(1)  # without leading "& sign
-                    mod = self.char.get_attribute_by_name(attr.group(1))
-                    hand.attrs.append((mod, name) if name else (None, name))
-                continue
-
-            # description (last word in formula)
-            if i == len(sequence) - 1:                 # if the last element
-                descr: re.Match = re.match(r'[a-zA-ZА-Яа-я\-_]{3,25}', elem)
-                if descr:
-                    hand.description = descr.group(0)
-                    break
-
-            # deal with +/-
-            if elem == '+': sign = 1         # noqa E701
-            elif elem == '-': sign = -1      # noqa E701
-
+        for step, arg in compile_formula(self.formula):
+            if step == 'dices':
+                hand.dices.append(DiceGroup(*arg))
+            elif step == 'modifier':
+                hand.modifiers.append(arg)
+            elif step in ('alias', 'attr') and self.offline \
+                    and not self.char:
+                hand.attrs.append((None, arg))
+            elif step == 'alias' and self.char:
+                mod, name = self.char.get_attribute_by_alias(alias=arg)
+                hand.attrs.append((mod, name) if name else (None, arg))
+            elif step == 'attr' and self.char:
+                mod = self.char.get_attribute_by_name(arg)
+                hand.attrs.append((mod, arg))
+            elif step == 'description':
+                hand.description = arg
         return hand
 
 
+@lru_cache(maxsize=1024)
+def compile_formula(formula: str) -> Tuple[tuple, ...]:
+    """
+    Compile formula into a plan: a tuple of (step, argument) pairs, where
+    step is one of 'dices' (DiceGroup arguments), 'modifier' (signed int),
+    'alias', 'attr' (char attribute alias or name) or 'description'.
+    Plans are cached, so formulas repeated by saved throws and inline
+    queries are parsed only once.
+    """
+    plan = []
+    sign = 1                             # sign in [1, -1]
+    sequence = formula.split()
+
+    for i, elem in enumerate(sequence):
+        # dices
+        spec = DiceGroup.spec(elem)
+        if spec:
+            plan.append(('dices', spec))
+            continue
+
+        # modifiers
+        modifier: re.Match = re.match(r'\d{1,3}', elem)
+        if modifier and re.match(r'\d{4}', elem):
+            # never add a part of it
+            raise FormulaError(
+                f'Cannot roll {html.escape(elem)}: a modifier is up to 999')
+        if modifier:
+            plan.append(('modifier', int(modifier.group(0))*sign))
+            sign = 1
+            continue
+
+        # custom char attributes and attr aliases
+        alias: re.Match = re.match(r'\$([a-zA-ZА-Яа-я\-_]{2,7})', elem)
+        attr: re.Match = re.match(r'&([a-zA-ZА-Яа-я\-_]{2,25})', elem)
+        if alias:
+            plan.append(('alias', alias.group(1)))
+            continue
+        if attr:
+            plan.append(('attr', attr.group(1)))  # without leading "& sign
+            continue
+
+        # description (last word in formula)
+        if i == len(sequence) - 1:                 # if the last element
+            descr: re.Match = re.match(r'[a-zA-ZА-Яа-я\-_]{3,25}', elem)
+            if descr:
+                plan.append(('description', descr.group(0)))
+                break
+
+        # deal with +/-
+        if elem == '+': sign = 1         # noqa E701
+        elif elem == '-': sign = -1      # noqa E701
+
+    return tuple(plan)
+
+
 if __name__ == '__main__':
 
     from collections import namedtuple
@@ -0,0 +1,136 @@
+"""
+Front router for several bot backends (processes running wsgi.py, each
+with a single worker). Telegram webhooks point to the router, and every
+update is forwarded to the backend which owns its chat on a hash ring
+(see common/affinity.py). So updates of a chat are always handled by
+the same process, in order, and caches of the chat stay in one place.
+
+    BACKENDS=http://127.0.0.1:8001,http://127.0.0.1:8002 \\
+        gunicorn -k gthread --threads 16 router:app
+
+A backend which refuses connections (or cannot be reached) is skipped
+for ROUTER_RETRY seconds and its chats go to the next backends on the
+ring; chats of other backends stay where they are. A backend which
+took the update but answers 503 (it drains) or does not answer in
+ROUTER_TIMEOUT may still be handling it, so its chats stay: Telegram
+gets 503 and sends the update again later, to the same backend while
+it is up. Chats move only once it stops accepting connections.
+
+GET /backends shows the state of the backends to requests with
+"Authorization: Bearer <METRICS_TOKEN>".
+"""
+
+import os
+import hmac
+import time
+import logging
+import threading
+
+import requests
+from flask import Flask, Response, abort, request
+
+from common.affinity import HashRing, update_key
+
+
+routerlogger = logging.getLogger('routerlogger')
+
+BACKENDS = [
+    backend.strip().rstrip('/')
+    for backend in os.environ.get('BACKENDS', '').split(',')
+    if backend.strip()
+]
+# seconds to wait for a backend to take an update
+ROUTER_TIMEOUT = float(os.environ.get('ROUTER_TIMEOUT', 10))
+# seconds a backend which refused a connection is skipped
+ROUTER_RETRY = float(os.environ.get('ROUTER_RETRY', 30))
+# /backends is served only with "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+if not BACKENDS:
+    routerlogger.warning('BACKENDS should be defined as system var')
+
+ring = HashRing(BACKENDS)
+session = requests.Session()
+# backend -> time it is skipped until
+down = {}
+down_lock = threading.Lock()
+
+app = Flask(__name__)
+
+
+def is_down(backend: str) -> bool:
+    with down_lock:
+        return down.get(backend, 0) > time.monotonic()
+
+
+def mark_down(backend: str, reason: object):
+    routerlogger.warning('Backend %s is skipped for %s s: %s',
+                         backend, ROUTER_RETRY, reason)
+    with down_lock:
+        down[backend] = time.monotonic() + ROUTER_RETRY
+
+
+def forward(token: str, body: bytes, key: int) -> bool:
+    """
+    Hand the update over to the first backend on the ring which accepts
+    the connection, False if it did not take the update
+    """
+    headers = {'Content-Type': 'application/json'}
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token')
+    if secret:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+    for backend in ring.nodes_for(key):
+        if is_down(backend):
+            continue
+        try:
+            response = session.post(
+                f'{backend}/{token}', data=body, headers=headers,
+                timeout=ROUTER_TIMEOUT)
+        except requests.ConnectionError as exc:
+            # refused or unreachable, the update never got there
+            mark_down(backend, exc)
+            continue
+        except requests.RequestException as exc:
+            # it may be handling the update: keep the chat there
+            routerlogger.warning('Backend %s failed: %s', backend, exc)
+            return False
+        if response.status_code == 404:
+            abort(404)
+        # 503 while draining: Telegram retries, the chat stays in order
+        return response.ok
+    return False
+
+
+@app.route('/<token>', methods=['POST'])
+def route_update(token):
+    body = request.get_data()
+    try:
+        key = update_key(request.get_json(force=True))
+    except (AttributeError, KeyError, TypeError, ValueError):
+        abort(400)
+    if not forward(token, body, key):
+        abort(503)
+    return "!", 200
+
+
+@app.route('/backends')
+def backends():
+    """
+    Backends and their state. The route is public like webhooks, so it
+    needs METRICS_TOKEN.
+    """
+    if not METRICS_TOKEN:
+        abort(404)
+    given = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(given, f'Bearer {METRICS_TOKEN}'):
+        abort(401)
+    lines = [
+        f'{backend} {"down" if is_down(backend) else "up"}'
+        for backend in ring.nodes
+    ]
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain')
+
+
+@app.route('/')
+def index():
+    return '.'
@@ -0,0 +1,186 @@
+"""
+Character sheets for /exportchar and /importchar. The text format
+mirrors the commands, one item per line:
+
+    char Tall
+    attr Dexterity DEX 14 2
+    attr Strength STR 20
+    throw Init d20 + $DEX
+
+JSON sheets have the same fields:
+
+    {"char": "Tall",
+     "attrs": [["Dexterity", "DEX", 14, 2]],
+     "throws": [["Init", "d20 + $DEX"]]}
+"""
+
+import json
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+from models import Attribute, Char, Throw
+from common.helpers import check_formula
+
+
+# attributes and throws per sheet
+MAX_SHEET_ITEMS = 100
+
+
+class SheetError(ValueError):
+    """
+    Raised with all problems found in a sheet at once
+    """
+
+    def __init__(self, errors: List[str]):
+        self.errors = errors
+        super().__init__('\n'.join(errors))
+
+
+@dataclass
+class SheetAttribute:
+    name: str
+    alias: str
+    value: int
+    modifier: int
+
+
+@dataclass
+class CharSheet:
+    name: str
+    attributes: List[SheetAttribute] = field(default_factory=list)
+    throws: List[Tuple[str, str]] = field(default_factory=list)
+
+    @classmethod
+    def of(cls, char: Char):
+        """
+        Sheet of a char (within db_session)
+        """
+        return cls(
+            name=char.name,
+            attributes=[
+                SheetAttribute(a.name, a.alias, a.value, a.modifier)
+                for a in char.attributes.order_by(Attribute.id)
+            ],
+            throws=[
+                (t.name, t.formula) for t in char.throws.order_by(Throw.id)
+            ],
+        )
+
+    def as_text(self) -> str:
+        lines = [f'char {self.name}']
+        lines.extend(
+            f'attr {a.name} {a.alias} {a.value} {a.modifier}'
+            for a in self.attributes)
+        lines.extend(
+            f'throw {name} {formula}' for name, formula in self.throws)
+        return '\n'.join(lines)
+
+    def as_json(self) -> str:
+        return json.dumps({
+            'char': self.name,
+            'attrs': [
+                [a.name, a.alias, a.value, a.modifier]
+                for a in self.attributes],
+            'throws': [list(throw) for throw in self.throws],
+        }, ensure_ascii=False, separators=(',', ':'))
+
+
+def parse(text: str) -> CharSheet:
+    """
+    Parse and validate a text or JSON sheet. Every line is checked and
+    SheetError lists all the problems, so nothing is written until the
+    whole sheet is fine.
+    """
+    text = text.strip()
+    if text.startswith('{'):
+        name, attrs, throws, errors = read_json(text)
+    else:
+        name, attrs, throws, errors = read_text(text)
+
+    if not name:
+        errors.append('Sheet has no char name (a line like "char Tall")')
+    else:
+        try:
+            Char.check_name(name)
+        except ValueError as exc:
+            errors.append(str(exc))
+    if len(attrs) + len(throws) > MAX_SHEET_ITEMS:
+        errors.append(
+            f'Sheet is too long, max {MAX_SHEET_ITEMS} attributes and throws')
+
+    sheet = CharSheet(name)
+    names, aliases, throw_names = set(), set(), set()
+    for line, fields in attrs:
+        try:
+            attr = SheetAttribute(*Attribute.check(*fields))
+        except (TypeError, ValueError) as exc:
+            errors.append(f'{line}: {exc}')
+            continue
+        if attr.name in names or attr.alias in aliases:
+            errors.append(f'{line}: attribute {attr.name} (${attr.alias}) '
+                          'is in the sheet already')
+        names.add(attr.name)
+        aliases.add(attr.alias)
+        sheet.attributes.append(attr)
+    for line, throw_name, formula in throws:
+        if not throw_name or not check_formula(formula):
+            errors.append(f'{line}: throw needs a name and a formula')
+        elif len(throw_name.split()) > 1:
+            errors.append(f'{line}: throw name must be a single word')
+        elif throw_name in throw_names:
+            errors.append(
+                f'{line}: throw {throw_name} is in the sheet already')
+        throw_names.add(throw_name)
+        sheet.throws.append((throw_name, formula))
+
+    if errors:
+        raise SheetError(errors)
+    return sheet
+
+
+def read_text(text: str) -> tuple:
+    name, attrs, throws, errors = '', [], [], []
+    for number, line in enumerate(text.splitlines(), 1):
+        kind, _, rest = line.strip().partition(' ')
+        rest = rest.strip()
+        label = f'Line {number}'
+        if not kind or kind.startswith('#'):
+            continue
+        elif kind == 'char':
+            name = rest
+        elif kind == 'attr':
+            fields = rest.split()
+            if len(fields) not in (3, 4):
+                errors.append(
+                    f'{label}: expected "attr Name ALIAS value [modifier]"')
+                continue
+            fields[1] = fields[1].lstrip('$')
+            attrs.append((label, fields))
+        elif kind == 'throw':
+            throw_name, _, formula = rest.partition(' ')
+            throws.append((label, throw_name, formula.strip()))
+        else:
+            errors.append(f'{label}: unknown item "{kind}"')
+    return name, attrs, throws, errors
+
+
+def read_json(text: str) -> tuple:
+    try:
+        data = json.loads(text)
+        name = str(data.get('char') or '').strip()
+        attrs = [
+            (f'Attribute {number}',
+             [str(value) if value is not None else '' for value in fields])
+            for number, fields in enumerate(data.get('attrs') or [], 1)
+        ]
+        for _, fields in attrs:
+            if len(fields) > 1:
+                fields[1] = fields[1].lstrip('$')
+        throws = [
+            (f'Throw {number}', str(throw_name), str(formula).strip())
+            for number, (throw_name, formula)
+            in enumerate(data.get('throws') or [], 1)
+        ]
+    except (AttributeError, TypeError, ValueError) as exc:
+        return '', [], [], [f'Invalid JSON sheet: {exc}']
+    return name, attrs, throws, []
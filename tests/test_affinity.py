@@ -0,0 +1,47 @@
+from common.affinity import HashRing
+
+NODES = [f'http://node{number}' for number in range(4)]
+KEYS = range(10000)
+
+
+def owners(ring: HashRing) -> dict:
+    return {key: ring.node_for(key) for key in KEYS}
+
+
+def test_join_moves_keys_to_new_node_only():
+    before = owners(HashRing(NODES))
+    after = owners(HashRing(NODES + ['http://new']))
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert moved
+    assert all(after[key] == 'http://new' for key in moved)
+    # about a fifth of keys, not a reshuffle
+    assert len(moved) < len(KEYS) / 3
+
+
+def test_leave_moves_keys_of_left_node_only():
+    before = owners(HashRing(NODES))
+    after = owners(HashRing(NODES[1:]))
+    for key in KEYS:
+        if before[key] != NODES[0]:
+            assert after[key] == before[key]
+
+
+def test_leave_moves_keys_to_next_node():
+    ring = HashRing(NODES)
+    left = HashRing(NODES[1:])
+    for key in KEYS:
+        order = list(ring.nodes_for(key))
+        if order[0] == NODES[0]:
+            assert left.node_for(key) == order[1]
+
+
+def test_nodes_for():
+    ring = HashRing(NODES)
+    for key in range(100):
+        order = list(ring.nodes_for(key))
+        assert order[0] == ring.node_for(key)
+        assert sorted(order) == sorted(NODES)
+
+
+def test_empty_ring():
+    assert HashRing([]).node_for(1) is None
@@ -0,0 +1,51 @@
+from collections import Counter
+from itertools import product
+
+import pytest
+
+from odds import die, keep_distribution, spec_distribution
+from roller import DiceGroup
+
+
+def brute_force(number: int, sides: int, keep: int, highest: bool) -> dict:
+    """
+    Odds of every total, rolling all the faces one by one
+    """
+    totals = Counter()
+    for faces in product(range(1, sides + 1), repeat=number):
+        ordered = sorted(faces, reverse=highest)
+        totals[sum(ordered[:keep])] += 1
+    outcomes = sides ** number
+    return {total: count / outcomes for total, count in totals.items()}
+
+
+def as_dict(dist) -> dict:
+    return {total: p for total, p in dist.items() if p}
+
+
+@pytest.mark.parametrize('number', [1, 2, 3, 4])
+@pytest.mark.parametrize('sides', [2, 3, 6])
+@pytest.mark.parametrize('highest', [True, False])
+def test_keep_distribution(number, sides, highest):
+    for keep in range(1, number + 1):
+        dist = keep_distribution(die(sides), number, keep, highest)
+        assert as_dict(dist) == pytest.approx(
+            brute_force(number, sides, keep, highest))
+
+
+@pytest.mark.parametrize('formula, keep, highest', [
+    ('4d6kh3', 3, True),
+    ('4d6k3', 3, True),
+    ('3d4kl1', 1, False),
+    ('4d6dl1', 3, True),
+    ('4d6d1', 3, True),
+    ('5d3dh2', 3, False),
+])
+def test_spec_distribution(formula, keep, highest):
+    number, sides, explode, *selection = DiceGroup.spec(formula)[:5]
+    assert selection == [keep, highest]
+    dist = spec_distribution(
+        (((number, sides, explode, keep, highest),), 2))
+    expected = brute_force(number, sides, keep, highest)
+    assert as_dict(dist) == pytest.approx(
+        {total + 2: p for total, p in expected.items()})
@@ -0,0 +1,58 @@
+import threading
+
+import pytest
+
+from common import rng
+
+
+def faces(seed: int, sides: int = 20, number: int = 1000) -> list:
+    return rng.StreamFactory(seed=seed).stream().faces(sides, number)
+
+
+def test_seeded_streams_repeat():
+    assert faces(42) == faces(42)
+    assert faces(42) != faces(43)
+
+
+def test_configure():
+    try:
+        rng.configure(seed=7)
+        first = rng.get_stream().faces(6, 100)
+        rng.configure(seed=7)
+        assert rng.get_stream().faces(6, 100) == first
+    finally:
+        rng.configure(seed=rng._seed_from_env())
+
+
+def test_streams_per_thread():
+    factory = rng.StreamFactory(seed=1)
+    streams = [factory.stream()]
+    thread = threading.Thread(target=lambda: streams.append(factory.stream()))
+    thread.start()
+    thread.join()
+    assert streams[0] is factory.stream()
+    assert streams[0] is not streams[1]
+
+
+@pytest.mark.parametrize('sides', [1, 2, 6, 20, 100, 256, 257, 999])
+def test_faces_in_range(sides):
+    result = faces(1, sides, 5000)
+    assert len(result) == 5000
+    assert min(result) >= 1 and max(result) <= sides
+    if sides <= 20:
+        assert set(result) == set(range(1, sides + 1))
+
+
+def test_randint_in_range():
+    stream = rng.StreamFactory(seed=3).stream()
+    values = [stream.randint(-2, 2) for _ in range(1000)]
+    assert set(values) == {-2, -1, 0, 1, 2}
+    assert stream.randint(5, 5) == 5
+
+
+def test_no_faces():
+    stream = rng.StreamFactory(seed=3).stream()
+    with pytest.raises(ValueError):
+        stream.faces(0, 3)
+    with pytest.raises(ValueError):
+        stream.randint(2, 1)
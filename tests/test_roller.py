@@ -0,0 +1,51 @@
+import pytest
+
+from roller import DiceGroup, FormulaError, compile_formula
+
+
+@pytest.mark.parametrize('elem, spec', [
+    ('d20', (1, 20, False, 1, True, '')),
+    ('2d6', (2, 6, False, 2, True, '')),
+    ('3д8', (3, 8, False, 3, True, '')),
+    ('4d6!', (4, 6, True, 4, True, '')),
+    ('4d6kh3', (4, 6, False, 3, True, 'kh3')),
+    ('4d6k3', (4, 6, False, 3, True, 'k3')),
+    ('2d20kl1', (2, 20, False, 1, False, 'kl1')),
+    ('4d6dl1', (4, 6, False, 3, True, 'dl1')),
+    ('4d6d1', (4, 6, False, 3, True, 'd1')),
+    ('4d6dh1', (4, 6, False, 3, False, 'dh1')),
+    ('2d6kh5', (2, 6, False, 2, True, 'kh5')),
+    ('2d6dl5', (2, 6, False, 0, True, 'dl5')),
+])
+def test_spec(elem, spec):
+    assert DiceGroup.spec(elem) == spec
+
+
+@pytest.mark.parametrize('elem', ['5', '+', 'str', 'dex', ''])
+def test_spec_not_dice(elem):
+    assert DiceGroup.spec(elem) is None
+
+
+@pytest.mark.parametrize('elem', [
+    '4d6kh100', 'd1000', '1000d6', '4d6x', '4d6kh', 'd0', '3d0',
+])
+def test_spec_invalid(elem):
+    with pytest.raises(FormulaError):
+        DiceGroup.spec(elem)
+
+
+@pytest.mark.parametrize('formula, plan', [
+    ('d20 + 2', (('dices', (1, 20, False, 1, True, '')), ('modifier', 2))),
+    ('2d6 - 999', (('dices', (2, 6, False, 2, True, '')),
+                   ('modifier', -999))),
+    ('d20 + $DEX Stealth', (('dices', (1, 20, False, 1, True, '')),
+                            ('alias', 'DEX'), ('description', 'Stealth'))),
+])
+def test_compile_formula(formula, plan):
+    assert compile_formula(formula) == plan
+
+
+@pytest.mark.parametrize('formula', ['d20 + 1000', '2d6 - 12345'])
+def test_compile_formula_invalid(formula):
+    with pytest.raises(FormulaError):
+        compile_formula(formula)
@@ -1,6 +1,10 @@
+import os
+from typing import Iterator, Set
+
 from jinja2 import Environment, PackageLoader, select_autoescape
 
 from models import User
+from odds import chances
 from common.unicode import emoji
 
 
@@ -12,6 +16,23 @@ env = Environment(
 env.trim_blocks = True
 env.lstrip_blocks = True
 
+# Telegram refuses messages longer than that
+MESSAGE_LIMIT = 4096
+# room for faces of all dice groups in a roll message
+DICE_TEXT_BUDGET = int(os.environ.get('DICE_TEXT_BUDGET', 3000))
+# formula shown in a collapsed roll message, characters
+FORMULA_PREVIEW = 200
+# histogram of faces is shown for compact groups of small dices only
+HISTOGRAM_MAX_VALUE = 20
+
+
+def preload():
+    """
+    Compile all templates ahead of the first updates
+    """
+    for name in env.list_templates():
+        env.get_template(name)
+
 
 def hello(username: str):
     """
@@ -29,6 +50,34 @@ def charlist(user: User):
     return template.render(user=user, emoji=emoji)
 
 
+def throw_changed(charname: str, name: str, formula: str = None):
+    """
+    Render confirmation of a throw added to the char, or deleted
+    if there is no formula
+    """
+    template = env.get_template("throw_changed.jinja2")
+    return template.render(
+        charname=charname, name=name, formula=formula, emoji=emoji)
+
+
+def attribute_changed(charname: str, name: str, attr: object = None):
+    """
+    Render confirmation of an attribute added to the char, or deleted
+    if there is no attr
+    """
+    template = env.get_template("attribute_changed.jinja2")
+    return template.render(
+        charname=charname, name=name, attr=attr, emoji=emoji)
+
+
+def char_activated(charname: str):
+    """
+    Render confirmation of a new active char
+    """
+    template = env.get_template("char_activated.jinja2")
+    return template.render(charname=charname, emoji=emoji)
+
+
 def command_help(command: str, error_text: str = ''):
     """
     Send help message about certain command
@@ -45,12 +94,169 @@ def error(error_text: str):
     return template.render(error_text=error_text, emoji=emoji)
 
 
+def compact_groups(hand: object) -> Set[int]:
+    """
+    Indexes of dice groups to be rendered as a compact summary, so that
+    the faces of the rest fit into DICE_TEXT_BUDGET. The biggest groups
+    are compacted first.
+    """
+    sizes = [dice_group.verbose_size() for dice_group in hand.dices]
+    total = sum(sizes)
+    compact = set()
+    for index in sorted(range(len(sizes)), key=sizes.__getitem__,
+                        reverse=True):
+        if total <= DICE_TEXT_BUDGET:
+            break
+        compact.add(index)
+        total -= sizes[index]
+    return compact
+
+
+def roll_size(roller: object, hand: object, compact: Set[int]) -> int:
+    """
+    Upper bound of the length of the rendered roll, without rendering
+    it: faces of the groups which are not compact, headers of all the
+    groups, attributes and modifiers lines
+    """
+    size = 400 + len(roller.formula) + len(roller.name or '')
+    size += 2 * len(hand.description)
+    for index, dice_group in enumerate(hand.dices):
+        size += 40 + len(repr(dice_group)) + len(str(dice_group.summary))
+        if index in compact:
+            size += 300
+        else:
+            size += dice_group.verbose_size()
+    size += sum(80 + len(str(attr[1])) for attr in hand.attrs)
+    size += 30 * len(hand.modifiers)
+    return size
+
+
+def roll_collapsed(roller: object, hand: object) -> bool:
+    """
+    Whether a roll does not fit into a message even with compact dice
+    groups, so groups, attributes and modifiers are rendered as totals
+    """
+    return roll_size(roller, hand, compact_groups(hand)) > MESSAGE_LIMIT
+
+
 def roll(roller: object, hand: object):
     """
     Render roll template
     """
     template = env.get_template("roll.jinja2")
-    return template.render(roller=roller, hand=hand, emoji=emoji)
+    compact = compact_groups(hand)
+    return template.render(
+        roller=roller, hand=hand, compact=compact,
+        collapsed=roll_size(roller, hand, compact) > MESSAGE_LIMIT,
+        formula_preview=FORMULA_PREVIEW,
+        histogram_max=HISTOGRAM_MAX_VALUE, emoji=emoji
+    )
+
+
+def roll_faces(roller: object, hand: object) -> Iterator[str]:
+    """
+    Full list of faces of a roll as plain text chunks
+    """
+    yield f'{roller.name} rolled {roller.formula.strip()}\n'
+    for dice_group in hand.dices:
+        yield f'\n{dice_group}: {dice_group.summary}\n'
+        for index, chain in enumerate(dice_group.rolls):
+            dropped = ' (dropped)' if index in dice_group.dropped else ''
+            yield '!'.join(map(str, chain)) + dropped + '\n'
+    yield f'\nResult: {hand.result}\n'
+
+
+def party(rolls: list, skipped: list, formula: str):
+    """
+    Render results of a party roll, sorted by totals (initiative order)
+    """
+    template = env.get_template("party.jinja2")
+    return template.render(
+        rolls=rolls, skipped=skipped, formula=formula, emoji=emoji)
+
+
+def party_members(chars: list):
+    """
+    Render the list of party chars
+    """
+    template = env.get_template("party_members.jinja2")
+    return template.render(chars=chars, emoji=emoji)
+
+
+def sheet(text: str):
+    """
+    Render a char sheet ready to be copied
+    """
+    template = env.get_template("sheet.jinja2")
+    return template.render(text=text, emoji=emoji)
+
+
+def sheet_errors(errors: list):
+    """
+    Render all problems found in an imported sheet
+    """
+    template = env.get_template("sheet_errors.jinja2")
+    return template.render(errors=errors, emoji=emoji)
+
+
+def sheet_imported(sheet: object, created: bool):
+    """
+    Render summary of an imported sheet
+    """
+    template = env.get_template("sheet_imported.jinja2")
+    return template.render(sheet=sheet, created=created, emoji=emoji)
+
+
+def history(charname: str, enabled: bool, records: list):
+    """
+    Render the latest rolls from char's history
+    """
+    template = env.get_template("history.jinja2")
+    return template.render(
+        charname=charname, enabled=enabled, records=records, emoji=emoji)
+
+
+def history_switched(charname: str, enabled: bool):
+    """
+    Render confirmation of switching roll history on/off
+    """
+    template = env.get_template("history_switched.jinja2")
+    return template.render(charname=charname, enabled=enabled, emoji=emoji)
+
+
+def odds(roller: object, distribution: object):
+    """
+    Render odds of a formula
+    """
+    template = env.get_template("odds.jinja2")
+    return template.render(
+        roller=roller, dist=distribution, chances=chances(distribution),
+        emoji=emoji
+    )
+
+
+def inline_help():
+    """
+    Render inline mode help
+    """
+    template = env.get_template("inline_help.jinja2")
+    return template.render(emoji=emoji)
+
+
+def unavailable():
+    """
+    Render reply for commands which need the database while it is down
+    """
+    template = env.get_template("unavailable.jinja2")
+    return template.render(emoji=emoji)
+
+
+def slow_down():
+    """
+    Render reply for throttled users
+    """
+    template = env.get_template("slow_down.jinja2")
+    return template.render(emoji=emoji)
 
 
 def statistics(stats):
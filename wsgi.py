@@ -1,37 +1,53 @@
 import os
+import hmac
+import time
 import logging
 
 import telebot
-from flask import Flask, request
+from flask import Flask, Response, abort, request
+from pony.orm import db_session
 
+import odds
+import views
 import models
+from common.analysis import analyzer
+from common.background import writer
+from common.database import bind_database
+from common.hosting import BotHost
+from common.metrics import counters
 
 
 botlogger = logging.getLogger('botlogger')
 
 TOKEN = os.environ.get('TOKEN')
+# several bots served by the app, comma separated
+TOKENS = [
+    token.strip() for token in os.environ.get('TOKENS', TOKEN or '').split(',')
+    if token.strip()
+]
 URL = os.environ.get('URL')
 DATABASE_URL = os.environ.get('DATABASE_URL')
-
-if not TOKEN:
-    botlogger.warning('TOKEN should be defined as system var')
+# threads handling updates of all the bots
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', 4))
+# another Bot API server, like a local one
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+# /metrics is served only with "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+if not TOKENS:
+    botlogger.warning('TOKEN or TOKENS should be defined as system var')
 if not URL:
     botlogger.warning('URL should be defined as system var')
 
 
-# connect to database
-creds, host_and_database = DATABASE_URL[11:].split('@')
-host_and_port, database = host_and_database.split('/')
-host, port = host_and_port.split(':')
-user, password = creds.split(':')
-
-models.db.bind(provider='postgres', user=user, password=password,
-               host=host, port=port, database=database)
-models.db.generate_mapping(create_tables=True)
+# connecting to database
+bind_database(models.db, DATABASE_URL)
 
 
-# Setting bot
-bot = telebot.TeleBot(TOKEN)
+# Setting bots
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL.rstrip('/') + '/bot{0}/{1}'
+host = BotHost(TOKENS, workers=UPDATE_WORKERS)
 tblogger = telebot.logger
 telebot.logger.setLevel(logging.INFO)
 
@@ -39,40 +55,105 @@ telebot.logger.setLevel(logging.INFO)
 app = Flask(__name__)
 
 # registering into flask
-app.config['TELEBOT'] = bot
+app.config['TELEBOT'] = host.default
 app.config['TELEBOT_LOGGER'] = tblogger
 
 # registering bot handlers
 with app.app_context():
 
     from handlers import BotHandlers
-    BotHandlers.register()
+    for number, bot in enumerate(host.bots.values()):
+        BotHandlers.register(bot, number)
+
+
+#
+# WORKER LIFECYCLE (see gunicorn.conf.py)
+#
+def warm_up():
+    """
+    Get a new worker ready before it takes updates: templates compiled,
+    dice tables mapped, analysis workers started, and every update
+    thread with its database connection and a connection to Telegram
+    """
+    started = time.monotonic()
+    views.preload()
+    odds.tables.load()
+    analyzer.start()
+
+    def connect():
+        with db_session:
+            models.db.select('SELECT 1')
+        if host.default is not None:
+            host.default.get_me()
+
+    host.warm_up(connect)
+    botlogger.info('Warmed up in %.2f s', time.monotonic() - started)
+
+
+def drain(timeout: float):
+    """
+    Finish the taken updates and store buffered writes and counters,
+    within timeout seconds
+    """
+    deadline = time.monotonic() + timeout
+    from handlers import inline_debouncer
+    left = host.drain(timeout)
+    # inline answers are debounced off the update threads
+    left += inline_debouncer.drain(max(deadline - time.monotonic(), 0.1))
+    if left:
+        botlogger.warning('%s updates were not handled before exit', left)
+    if not writer.flush(max(deadline - time.monotonic(), 0.1)):
+        botlogger.warning(
+            '%s buffered writes were not stored', writer.pending)
+    counters.flush()
 
 
 #
 # FLASK ROUTES
 #
-@app.route('/' + TOKEN, methods=['POST'])
-def get_message():
+@app.route('/<token>', methods=['POST'])
+def get_message(token):
+    if token not in host.bots:
+        abort(404)
     json_string = request.get_data().decode('utf-8')
     update = telebot.types.Update.de_json(json_string)
     app.logger.debug('Get some message')
-    bot.process_new_updates([update])
+    if not host.submit(token, update):
+        # draining: Telegram (or the router) sends it again later
+        abort(503)
     return "!", 200
 
 
 @app.route('/setwebhook', methods=['GET', 'POST'])
 def set_webhook():
-    bot.remove_webhook()
-    s = bot.set_webhook('{URL}{HOOK}'.format(URL=URL, HOOK=TOKEN))
-    if s:
+    failed = []
+    for token, bot in host.bots.items():
+        bot.remove_webhook()
+        if not bot.set_webhook('{URL}{HOOK}'.format(URL=URL, HOOK=token)):
+            failed.append(token)
+    if not failed:
         app.logger.info('Webhook setup successful')
         return "webhook setup ok"
     else:
-        app.logger.critical('Webhook setup failed!')
+        app.logger.critical('Webhook setup failed for %s of %s bots!',
+                            len(failed), len(host.bots))
         return "webhook setup failed"
 
 
+@app.route('/metrics')
+def metrics():
+    """
+    Counters of all workers of the host, in Prometheus text format.
+    The route is public like webhooks, so it needs METRICS_TOKEN.
+    """
+    if not METRICS_TOKEN:
+        abort(404)
+    given = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(given, f'Bearer {METRICS_TOKEN}'):
+        abort(401)
+    return Response(counters.prometheus(host.labels), mimetype='text/plain')
+
+
 @app.route('/')
 def index():
     app.logger.debug('Operational test. Serving normally')